@@ -1,10 +1,12 @@
 import asyncio
-import functools
+import time
 
 import peewee
 from peewee_async import AsyncDatabase
 import playhouse.sqlite_ext as sqlite_ext
 
+import prometheus
+
 try:
     import aiosqlite
 except ImportError:
@@ -12,54 +14,163 @@ except ImportError:
 
 __all__ = ["SqliteDatabase", "SqliteExtDatabase"]
 
+DEFAULT_READERS = 4
+DEFAULT_PRAGMAS = (
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+)
+READ_STATEMENTS = ('SELECT', 'EXPLAIN')
+
+
+class PoolStats:
+    def __init__(self):
+        self.acquired = 0
+        self.waiting = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def as_dict(self):
+        return {
+            'acquired': self.acquired,
+            'waiting': self.waiting,
+            'wait_total': self.wait_total,
+            'wait_max': self.wait_max,
+        }
+
 
 class AsyncSqliteConnection:
-    def __init__(self, *, database=None, loop=None, timeout=None, **kwargs):
+    """Pool of long-lived aiosqlite connections.
+
+    Reads outside of a transaction are spread over ``readers`` connections,
+    everything else (writes and whole transactions) is queued for the single
+    writer connection, so SQLite never sees two writers at once.
+    """
+
+    def __init__(self, *, database=None, loop=None, timeout=None, readers=DEFAULT_READERS, pragmas=(), **kwargs):
         self._created_connections = []
+        self._readers = None
+        self._writer = None
+        self._writer_conn = None
         self.loop = loop
         self.database = database
         self.timeout = timeout
+        self.readers = readers
+        self.pragmas = dict(DEFAULT_PRAGMAS, **dict(pragmas or ()))
         self.connect_kwargs = kwargs
+        self.stats = {'reader': PoolStats(), 'writer': PoolStats()}
 
-    async def acquire(self):
-        conn = aiosqlite.connect(database=self.database, **self.connect_kwargs)
+    async def _open(self):
+        conn = await aiosqlite.connect(database=self.database, isolation_level=None, **self.connect_kwargs)
+        for pragma, value in self.pragmas.items():
+            await conn.execute(f'PRAGMA {pragma} = {value}')
         self._created_connections.append(conn)
-        return await conn.__aenter__()
+        return conn
 
-    def release(self, conn):
-        if conn in self._created_connections:
-            self._created_connections.remove(conn)
+    async def connect(self):
+        self._writer = asyncio.Queue()
+        self._readers = asyncio.Queue()
+        self._writer_conn = await self._open()
+        self._writer.put_nowait(self._writer_conn)
+        for _ in range(self.readers):
+            self._readers.put_nowait(await self._open())
+
+    async def _get(self, queue, role):
+        stats = self.stats[role]
+        stats.waiting += 1
+        started = time.monotonic()
+        try:
+            conn = await queue.get()
+        finally:
+            stats.waiting -= 1
+        waited = time.monotonic() - started
+        stats.acquired += 1
+        stats.wait_total += waited
+        stats.wait_max = max(stats.wait_max, waited)
+        return conn
 
-        async def _internal():
-            await conn.commit()
-            await conn.__aexit__(None, None, None)
+    async def acquire(self):
+        return await self._get(self._writer, 'writer')
 
-        loop = self.loop or asyncio.get_event_loop()
-        loop.create_task(_internal())
+    async def acquire_for(self, sql):
+        if self.readers and sql.lstrip().upper().startswith(READ_STATEMENTS):
+            return await self._get(self._readers, 'reader')
+        return await self.acquire()
 
-    async def connect(self):
-        pass
+    def release(self, conn):
+        if conn is self._writer_conn:
+            self._writer.put_nowait(conn)
+        elif conn in self._created_connections:
+            self._readers.put_nowait(conn)
+
+    def pool_stats(self):
+        return {
+            'readers': self.readers,
+            'readers_idle': self._readers.qsize() if self._readers else 0,
+            'writer_idle': self._writer.qsize() if self._writer else 0,
+            **{role: stats.as_dict() for role, stats in self.stats.items()},
+        }
 
     async def close(self):
         for conn in self._created_connections:
-            await conn.__aexit__(None, None, None)
+            await conn.close()
         self._created_connections = []
+        self._writer_conn = None
 
     async def cursor(self, conn=None, *args, **kwargs):
-        in_transaction = conn is not None
-        if not conn:
-            conn = await self.acquire()
-        cursor = await conn.cursor()
-        cursor.release = functools.partial(
-            self.release_cursor, cursor,
-            in_transaction=in_transaction)
-        return cursor
-
-    async def release_cursor(self, cursor, in_transaction=False):
-        conn = cursor._conn
-        await cursor.__aexit__(None, None, None)
-        if not in_transaction:
-            self.release(conn)
+        return PooledCursor(self, conn)
+
+
+class PooledCursor:
+    """Cursor that takes a connection from the pool on ``execute``.
+
+    Inside a transaction it is bound to the transaction connection and never
+    returns it to the pool by itself.
+    """
+
+    def __init__(self, pool, conn=None):
+        self._pool = pool
+        self._conn = conn
+        self._owns_conn = conn is None
+        self._cursor = None
+
+    async def execute(self, sql, parameters=None):
+        statement = sql.split(None, 1)[0].upper() if prometheus.ENABLED else None
+        with prometheus.sql_seconds.time(statement):
+            if self._conn is None:
+                self._conn = await self._pool.acquire_for(sql)
+            self._cursor = await self._conn.execute(sql, parameters)
+        return self
+
+    async def fetchone(self):
+        return await self._cursor.fetchone()
+
+    async def fetchmany(self, size=None):
+        return await self._cursor.fetchmany(size)
+
+    async def fetchall(self):
+        return await self._cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    async def release(self):
+        try:
+            if self._cursor is not None:
+                await self._cursor.close()
+        finally:
+            if self._owns_conn and self._conn is not None:
+                self._pool.release(self._conn)
+            self._cursor = None
+            self._conn = None
 
 
 class AsyncSqliteMixin(AsyncDatabase):
@@ -68,10 +179,11 @@ class AsyncSqliteMixin(AsyncDatabase):
 
         Error = sqlite3.Error
 
-    def init_async(self, conn_class=AsyncSqliteConnection):
+    def init_async(self, conn_class=AsyncSqliteConnection, readers=DEFAULT_READERS):
         if not aiosqlite:
             raise Exception("Error, aiosqlite is not installed!")
         self._async_conn_cls = conn_class
+        self._async_readers = readers
 
     @property
     def connect_kwargs_async(self):
@@ -80,15 +192,21 @@ class AsyncSqliteMixin(AsyncDatabase):
     async def last_insert_id_async(self, cursor):
         return cursor.lastrowid
 
+    def pool_stats(self):
+        if self._async_conn is None:
+            return None
+        return self._async_conn.pool_stats()
+
 
 class SqliteDatabase(AsyncSqliteMixin, peewee.SqliteDatabase):
-    def init(self, database, **kwargs):
+    def init(self, database, readers=DEFAULT_READERS, **kwargs):
         super().init(database, **kwargs)
-        self.init_async()
+        self.init_async(readers=readers)
 
     @property
     def connect_params_async(self):
         kwargs = self.connect_params.copy()
+        kwargs.update(readers=self._async_readers, pragmas=self._pragmas)
         return kwargs
 
 
@@ -0,0 +1,95 @@
+import asyncio
+import functools
+import logging
+from typing import Optional
+
+import entities as e
+from cache import LRUCache
+
+CACHE_SIZE = 100000
+VERIFY_INTERVAL = 300
+VERIFY_BATCH = 500
+
+logger = logging.getLogger(__name__)
+cache = LRUCache(maxsize=CACHE_SIZE)
+verify_task: Optional[asyncio.Task] = None
+mismatches = 0
+
+
+async def run():
+    global cache, verify_task
+    await shutdown()
+    cache = LRUCache(maxsize=CACHE_SIZE)
+    verify_task = asyncio.create_task(verify_loop())
+
+
+async def shutdown():
+    global verify_task
+    if not isinstance(verify_task, asyncio.Task):
+        return
+    verify_task.cancel()
+    await asyncio.gather(verify_task, return_exceptions=True)
+    verify_task = None
+
+
+async def load(user_id):
+    return await e.objects.scalar(e.User.select(e.User.balance).where(e.User.id == user_id)) or 0
+
+
+async def get(user_id):
+    """User balance in nanotons, read from the database only on a cache miss."""
+    return await cache.get_or_load(user_id, functools.partial(load, user_id))
+
+
+def apply(deltas):
+    """Apply committed balance changes, a mapping of user_id to delta.
+
+    Must be called right after the commit without awaiting in between. Users that are not cached are dropped, which
+    also discards any load of them that started before the commit.
+    """
+    for user_id, delta in deltas.items():
+        balance = cache.peek(user_id)
+        if balance is None:
+            cache.pop(user_id)
+        else:
+            cache.set(user_id, balance + delta)
+
+
+async def verify():
+    """Compare cached balances with the database and fix the ones that drifted."""
+    global mismatches
+    user_ids = cache.keys()
+    for i in range(0, len(user_ids), VERIFY_BATCH):
+        batch = {user_id: cache.peek(user_id) for user_id in user_ids[i:i + VERIFY_BATCH]}
+        stored = dict(await e.objects.execute(
+            e.User.select(e.User.id, e.User.balance).where(e.User.id.in_(list(batch))).tuples()
+        ))
+        for user_id, cached in batch.items():
+            # Entries evicted or changed by a write-through during the query are not comparable
+            if cached is None or cache.peek(user_id) != cached:
+                continue
+            if cached != stored.get(user_id, 0):
+                mismatches += 1
+                logger.warning('Balance of %s drifted: cached %s, stored %s', user_id, cached, stored.get(user_id, 0))
+                cache.pop(user_id)
+
+
+async def verify_loop():
+    while True:
+        await asyncio.sleep(VERIFY_INTERVAL)
+        try:
+            await verify()
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.exception('Balance verification exception: %r', err)
+
+
+def metrics():
+    return {
+        'size': len(cache),
+        'hits': cache.hits,
+        'misses': cache.misses,
+        'hit_rate': cache.hit_rate(),
+        'mismatches': mismatches,
+    }
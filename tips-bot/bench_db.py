@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Times the hot-path queries on synthetic transactions, before and after the index migration.
+
+    ./bench_db.py --transactions 2000000 --database /tmp/bench.db
+"""
+import argparse
+import json
+import os
+import random
+import time
+
+import entities as e
+import migrations
+
+QUERIES = {
+    'user_history': (
+        'SELECT rowid, date, amount, invoice_id FROM "transaction" WHERE user_id = ? ORDER BY rowid DESC LIMIT 50',
+        lambda args: (random.randrange(args.users),),
+    ),
+    'user_balance': (
+        'SELECT SUM(amount) FROM "transaction" WHERE user_id = ?',
+        lambda args: (random.randrange(args.users),),
+    ),
+    'invoice_reconciliation': (
+        'SELECT SUM(amount) FROM "transaction" WHERE invoice_id = ?',
+        lambda args: (f'invoice{random.randrange(args.invoices)}',),
+    ),
+    'invoice_by_message': (
+        'SELECT id FROM invoice WHERE chat_id = ? AND message_id = ?',
+        lambda args: (-random.randrange(args.chats), random.randrange(args.invoices // args.chats)),
+    ),
+}
+HOT_PATH_INDEXES = ['transaction_user_id', 'transaction_invoice_id', 'transaction_wallet_id',
+                    'invoice_chat_id_message_id', 'transaction_user_id_rowid_date', 'transaction_invoice_id_rowid_date']
+
+
+def fill(args):
+    e.init_database(args.database)
+    e.database.create_tables([e.Invoice, e.Wallet, e.Transaction, e.User])
+    for index in HOT_PATH_INDEXES:
+        e.database.execute_sql(f'DROP INDEX IF EXISTS "{index}"')
+    conn = e.database.connection()
+    conn.execute('PRAGMA journal_mode = wal')
+    conn.execute('PRAGMA synchronous = off')
+    conn.execute('BEGIN')
+    conn.execute("INSERT INTO wallet (id, address) VALUES (1, 'wallet')")
+    conn.executemany(
+        "INSERT INTO invoice (id, chat_id, message_id, funded, message, entities) VALUES (?, ?, ?, 0, '', '')",
+        ((f'invoice{i}', -(i % args.chats), i // args.chats) for i in range(args.invoices)),
+    )
+    conn.executemany(
+        'INSERT INTO "transaction" (user_id, date, amount, wallet_id, invoice_id) VALUES (?, ?, ?, 1, ?)',
+        ((random.randrange(args.users), 1600000000 + i, random.randrange(10 ** 7, 10 ** 10),
+          f'invoice{random.randrange(args.invoices)}') for i in range(args.transactions)),
+    )
+    conn.execute('COMMIT')
+
+
+def measure(args):
+    conn = e.database.connection()
+    results = {}
+    for name, (sql, params) in QUERIES.items():
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            conn.execute(sql, params(args)).fetchall()
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        results[name] = {
+            'p50_ms': timings[len(timings) // 2] * 1000,
+            'max_ms': timings[-1] * 1000,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database', type=str, default='bench.db')
+    parser.add_argument('--transactions', type=int, default=2000000)
+    parser.add_argument('--invoices', type=int, default=100000)
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    if os.path.exists(args.database):
+        os.remove(args.database)
+    started = time.perf_counter()
+    fill(args)
+    report = {'transactions': args.transactions, 'fill_s': time.perf_counter() - started, 'before': measure(args)}
+    e.database.close()
+    report['schema_version'] = migrations.migrate(e.database.obj)
+    report['after'] = measure(args)
+    e.database.close()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""Runs the whole bot (main.run) against fake_telegram and fake_gateway and times scripted workloads.
+
+    ./bench_load.py --posts 300 --tips 2000 --withdrawals 100 > report.json
+
+Workloads run one after another: a storm of channel posts, a flood of tips to one post and a wave of withdrawals.
+Each reports throughput and p50/p99 latency, the JSON report goes to stdout. The exit status is 1 if a workload didn't
+complete within --timeout.
+
+For postgres, start the service of docker-compose.yml, which matches the connection parameters of config.json. Every
+table of --database is dropped first:
+
+    docker compose up -d postgres
+    ./bench_load.py --backend postgres --database tips_bench > report.json
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import sys
+import time
+
+import entities as e
+import lang
+import main as bot_main
+import migrations
+import money
+from fake_gateway import FakeGateway
+from fake_telegram import FakeTelegram
+
+WALLET = 'EQ_bench_wallet'
+# Withdrawals are only accepted to well-formed addresses
+DESTINATION = 'EQAa_d5RopvY6ZLcQFNJHFmdA8wf_igH-V-5Jc8DRprJIZa-'
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+
+def summary(latencies, started, finished, expected):
+    """Latencies in seconds, throughput over the whole run of the workload."""
+    duration = finished - started
+    return {
+        'count': len(latencies),
+        'expected': expected,
+        'duration_s': round(duration, 3),
+        'throughput_per_s': round(len(latencies) / duration, 1) if duration > 0 else None,
+        'p50_ms': latencies and round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': latencies and round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+
+async def wait_until(predicate, timeout):
+    deadline = time.perf_counter() + timeout
+    while not await predicate() and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+
+def calls(telegram, method, since):
+    return [call for call in telegram.calls if call[0] == method and call[2] >= since]
+
+
+async def post_storm(args, telegram):
+    """Channel posts spread over channels, latency is from the post to the bot's tips message."""
+    started = time.perf_counter()
+    posted = collections.defaultdict(list)
+    for i in range(args.posts):
+        chat_id = -1000 - i % args.channels
+        posted[chat_id].append(telegram.added[telegram.channel_post(chat_id)['update_id']])
+
+    async def done():
+        return len(calls(telegram, 'sendMessage', started)) >= args.posts
+    await wait_until(done, args.timeout)
+    sent = collections.defaultdict(list)
+    for _, params, at in calls(telegram, 'sendMessage', started):
+        sent[params['chat_id']].append(at)
+    # Posts of a chat are answered in order
+    latencies = [at - added for chat_id, times in sent.items() for added, at in zip(posted[chat_id], times)]
+    return summary(latencies, started, max(max(times) for times in sent.values()) if sent else started, args.posts)
+
+
+async def tip_flood(args, gateway):
+    """Tips to one post, latency is the /tracking acknowledgement, throughput is until the total is stored."""
+    invoice = (await e.objects.execute(e.Invoice.select().order_by(e.Invoice.chat_id.desc()).limit(1)))[0]
+    amount = money.NANO
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def pay(count):
+        async with semaphore:
+            sent = time.perf_counter()
+            status, _ = await gateway.pay(WALLET, [(invoice.id, amount)] * count)
+            if status == 202:
+                latencies.append(time.perf_counter() - sent)
+
+    started = time.perf_counter()
+    batches = [args.tips_per_callback] * (args.tips // args.tips_per_callback)
+    await asyncio.gather(*(pay(count) for count in batches))
+    total = amount * sum(batches)
+
+    async def done():
+        return await e.objects.scalar(e.Invoice.select(e.Invoice.funded).where(e.Invoice.id == invoice.id)) >= total
+    await wait_until(done, args.timeout)
+    result = summary(latencies, started, time.perf_counter(), len(batches))
+    result['tips'] = sum(batches)
+    result['tips_per_s'] = round(sum(batches) / result['duration_s'], 1)
+    return result
+
+
+async def withdrawal_wave(args, telegram):
+    """Withdrawals of different users, latency is from the request to the 'executed' edit."""
+    started = time.perf_counter()
+    requested = {}
+    for user_id in range(1, args.withdrawals + 1):
+        update = telegram.private_message(user_id, f'{DESTINATION} {args.withdraw_amount}', reply_to=1)
+        requested[user_id] = telegram.added[update['update_id']]
+
+    def executed():
+        return {
+            params['chat_id']: at for _, params, at in calls(telegram, 'editMessageText', started)
+            if params.get('text') == lang.WITHDRAW_EXECUTED
+        }
+
+    async def done():
+        return len(executed()) >= args.withdrawals
+    await wait_until(done, args.timeout)
+    finished = executed()
+    latencies = [at - requested[chat_id] for chat_id, at in finished.items()]
+    return summary(latencies, started, max(finished.values(), default=started), args.withdrawals)
+
+
+def reset(config):
+    """Drop the database of a previous run, a postgres one keeps existing with no tables."""
+    if config.get('database_backend', e.SQLITE) == e.SQLITE:
+        if os.path.exists(config['database']):
+            os.remove(config['database'])
+        return bot_main.init_database(config)
+    database = bot_main.init_database(config)
+    for table in database.get_tables():
+        database.execute_sql(f'DROP TABLE "{table}" CASCADE')
+    return database
+
+
+def prepare(args):
+    with open(args.config) as file:
+        config = json.load(file)
+    config['database'] = args.database
+    if args.backend:
+        config['database_backend'] = args.backend
+    migrations.migrate(reset(config))
+    e.Wallet.create(address=WALLET, private_key='bench')
+    balance = money.to_nano(args.withdraw_amount) * 2
+    e.User.insert_many([{'id': user_id, 'balance': balance} for user_id in range(1, args.withdrawals + 1)]).execute()
+    e.database.close()
+    config.update({
+        'host': '127.0.0.1',
+        'port': args.port,
+        'ton_gateway': f'http://127.0.0.1:{args.port + 2}',
+        'bot_api_url': f'http://127.0.0.1:{args.port + 1}/bot',
+        'bot_token': 'bench',
+        'payout_batch_window': args.batch_window,
+        'webhook': {'url': '', 'secret': ''},
+    })
+    config_file = f'{args.database}.json'
+    with open(config_file, 'w') as file:
+        json.dump(config, file)
+    return config_file
+
+
+async def bench(args):
+    import bot
+    import tracking
+    telegram = FakeTelegram(port=args.port + 1, flood_rate=args.flood_rate)
+    gateway = FakeGateway(port=args.port + 2, send_delay=args.send_delay)
+    report = {}
+    try:
+        await telegram.start()
+        await gateway.start()
+        await bot_main.run(prepare(args))
+        report['post_storm'] = await post_storm(args, telegram)
+        report['tip_flood'] = await tip_flood(args, gateway)
+        report['tip_flood']['edits'] = len(calls(telegram, 'editMessageText', 0))
+        report['withdrawal_wave'] = await withdrawal_wave(args, telegram)
+        report['telegram'] = {'calls': len(telegram.calls), 'flooded': telegram.flooded}
+        report['gateway'] = {'transfers': len(gateway.sent)}
+        report['metrics'] = {
+            'dispatcher': bot.dispatcher.metrics(),
+            'scheduler': bot.scheduler.metrics(),
+            'tracking': tracking.metrics(),
+            'database': e.database.pool_stats() if hasattr(e.database, 'pool_stats') else None,
+        }
+        print(json.dumps(report, indent=2, default=str))
+        args.incomplete = [
+            name for name, result in report.items() if result.get('count', 0) < result.get('expected', 0)
+        ]
+    finally:
+        # Stop polling first, so the bot doesn't lose its fakes while still running
+        await bot.shutdown()
+        await gateway.stop()
+        await telegram.stop()
+        await bot_main.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default=bot_main.CONFIG)
+    parser.add_argument('--database', type=str, default='bench_load.db', help='a file for sqlite, a name for postgres')
+    parser.add_argument('--backend', choices=[e.SQLITE, e.POSTGRES], help='the one of --config by default')
+    parser.add_argument('--port', type=int, default=18100, help='bot port, the fakes use the next two')
+    parser.add_argument('--posts', type=int, default=300)
+    parser.add_argument('--channels', type=int, default=100)
+    parser.add_argument('--tips', type=int, default=2000)
+    parser.add_argument('--tips-per-callback', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--withdrawals', type=int, default=100)
+    parser.add_argument('--withdraw-amount', type=str, default='0.5')
+    parser.add_argument('--send-delay', type=float, default=0.05)
+    parser.add_argument('--batch-window', type=float, default=0.2)
+    parser.add_argument('--flood-rate', type=float, default=0.01)
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+    args.incomplete = None
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.get_event_loop()
+    asyncio.ensure_future(bench(args))
+    loop.run_forever()
+    loop.close()
+    if args.incomplete or args.incomplete is None:
+        sys.exit(f'Incomplete workloads: {args.incomplete}' if args.incomplete else 'Benchmark failed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""Times the fee split of money.py against the former Decimal math, test_money.py checks that it loses no nanotons.
+
+    ./bench_money.py --amounts 1000000
+"""
+import argparse
+import json
+import random
+import time
+from decimal import Decimal
+
+import money
+
+
+def decimal_shares(amounts, fee):
+    return [int(amount * (1 - fee / 100)) for amount in amounts]
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--amounts', type=int, default=1000000)
+    parser.add_argument('--fee-bps', type=int, default=100)
+    args = parser.parse_args()
+    amounts = [random.randrange(1, 10 ** 12) for _ in range(args.amounts)]
+    fee = Decimal(args.fee_bps) / 100
+    report = {
+        'amounts': args.amounts,
+        'decimal_s': timed(decimal_shares, amounts, fee),
+        'int_s': timed(money.split_many, amounts, args.fee_bps),
+    }
+    report['speedup'] = report['decimal_s'] / report['int_s']
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
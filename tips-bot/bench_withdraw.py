@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""Fires concurrent withdrawals and tips at a few balances and checks that they are never overdrawn.
+
+    ./bench_withdraw.py --users 20 --withdrawals 1000 --concurrency 200 > report.json
+
+Each user starts with a balance covering --covered withdrawals, and tips keep crediting the same users meanwhile.
+Balances are sampled from the database while the withdrawals run, none may go negative. At the end every user must
+have exactly the balance implied by the tips and the withdrawals that went through, and reconcile.full must find no
+difference between the balances and the ledger. The exit status is 1 if a check fails.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+import entities as e
+import main as bot_main
+import migrations
+import money
+import payouts
+import reconcile
+import ton
+
+WALLET = 'EQ_bench_wallet'
+DESTINATION = 'EQAa_d5RopvY6ZLcQFNJHFmdA8wf_igH-V-5Jc8DRprJIZa-'
+CHAT_ID = -100
+WALLET_ID = 1
+
+
+def tip_rows(user_id, amount, count):
+    return [{
+        'user_id': user_id,
+        'date': ton.now_utc(),
+        'amount': amount,
+        'wallet': WALLET_ID,
+        'invoice': 'bench',
+        'chat_id': CHAT_ID,
+        'lt': None,
+        'hash': None,
+    } for _ in range(count)]
+
+
+async def prepare(args):
+    migrations.migrate(e.database.obj)
+    await e.objects.create(e.Wallet, address=WALLET, private_key='bench')
+    await e.objects.create(e.Invoice, id='bench', chat_id=CHAT_ID, message_id=1)
+    # The starting balances come from tips too, so the ledger explains them
+    for user_id in range(1, args.users + 1):
+        await ton.save_tips(tip_rows(user_id, args.gross, args.covered))
+    await payouts.allocator.load()
+
+
+async def sample(state):
+    """Lowest balance seen in the database until state['done']."""
+    while not state['done']:
+        lowest = await e.objects.scalar(e.User.select(e.User.balance).order_by(e.User.balance).limit(1))
+        state['lowest'] = lowest if state['lowest'] is None else min(state['lowest'], lowest)
+        state['samples'] += 1
+        await asyncio.sleep(0)
+
+
+async def withdrawals(args, state, targets):
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def withdraw(user_id):
+        async with semaphore:
+            # The same pre-check as bot.handle_reply, it reads the balance outside of the debit
+            if args.share > await ton.get_user_available_balance(user_id):
+                state['refused'][user_id] += 1
+                return
+            try:
+                await ton.withdraw(user_id=user_id, address=DESTINATION, amount=args.share)
+            except ton.InsufficientFunds:
+                state['refused'][user_id] += 1
+            else:
+                state['executed'][user_id] += 1
+
+    await asyncio.gather(*map(withdraw, targets))
+
+
+async def tips(args, state):
+    for _ in range(args.tips):
+        user_id = random.randrange(1, args.users + 1)
+        await ton.save_tips(tip_rows(user_id, args.gross, 1))
+        state['tipped'][user_id] += 1
+        await asyncio.sleep(0)
+
+
+async def check(args, state):
+    failures = []
+    if state['lowest'] is not None and state['lowest'] < 0:
+        failures.append(f'Balance went down to {state["lowest"]}')
+    stored = dict(await e.objects.execute(e.User.select(e.User.id, e.User.balance).tuples()))
+    for user_id in range(1, args.users + 1):
+        credited = (args.covered + state['tipped'][user_id]) * args.share
+        expected = credited - state['executed'][user_id] * args.share
+        if stored[user_id] != expected:
+            failures.append(f'User {user_id} has {stored[user_id]} instead of {expected}')
+        # Tips only add, so whatever the starting balance covered must have gone through
+        if state['executed'][user_id] < min(args.covered, state['requested'][user_id]):
+            failures.append(f'User {user_id} was refused withdrawals the balance covered')
+    withdrawals_stored = await e.objects.count(e.Withdrawal.select())
+    if withdrawals_stored != sum(state['executed'].values()):
+        failures.append(f'{withdrawals_stored} withdrawals stored for {sum(state["executed"].values())} executed')
+    ledger = await reconcile.full(ton.FEE_BPS)
+    for kind in (reconcile.USERS, reconcile.INVOICES):
+        if ledger[kind]['mismatched']:
+            failures.append(f'Ledger differences in {kind}: {ledger[kind]["sample"]}')
+    return failures
+
+
+async def bench(args):
+    config = bot_main.load_config(args.config)
+    config['database'] = args.database
+    if config.get('database_backend', e.SQLITE) == e.SQLITE:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.database + suffix):
+                os.remove(args.database + suffix)
+    config['processes'] = 1
+    bot_main.init_database(config)
+    if 'fee' in config:
+        ton.FEE_BPS = money.percent_to_bps(config['fee'])
+    args.share = money.split(args.gross, ton.FEE_BPS)[0]
+    try:
+        await prepare(args)
+        random.seed(args.seed)
+        targets = [random.randrange(1, args.users + 1) for _ in range(args.withdrawals)]
+        state = {
+            'done': False, 'lowest': None, 'samples': 0,
+            'executed': Counter(), 'refused': Counter(), 'tipped': Counter(), 'requested': Counter(targets),
+        }
+        sampler = asyncio.create_task(sample(state))
+        started = time.perf_counter()
+        await asyncio.gather(withdrawals(args, state, targets), tips(args, state))
+        duration = time.perf_counter() - started
+        state['done'] = True
+        await sampler
+        failures = await check(args, state)
+        print(json.dumps({
+            'withdrawals': args.withdrawals,
+            'executed': sum(state['executed'].values()),
+            'refused': sum(state['refused'].values()),
+            'tips': args.tips,
+            'duration_s': round(duration, 3),
+            'withdrawals_per_s': round(args.withdrawals / duration, 1),
+            'balance_samples': state['samples'],
+            'lowest_balance': state['lowest'],
+            'failures': failures,
+        }, indent=2))
+        return failures
+    finally:
+        await e.objects.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default=bot_main.CONFIG)
+    parser.add_argument('--database', type=str, default='bench_withdraw.db', help='dropped and created, if sqlite')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--withdrawals', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--covered', type=int, default=20, help='withdrawals covered by each starting balance')
+    parser.add_argument('--tips', type=int, default=200)
+    parser.add_argument('--gross', type=int, default=money.NANO, help='nanotons per tip, withdrawals take its share')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if asyncio.run(bench(args)):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,62 +1,259 @@
 import asyncio
 import base64
+import functools
+import json
 import logging
 import re
 import struct
-from decimal import Decimal
+import time
+from datetime import timedelta
 from typing import Optional
 
-from telegram import Bot, Update, ChatMemberOwner, InlineKeyboardMarkup, InlineKeyboardButton, ForceReply
-from telegram.constants import ParseMode
-from telegram.error import TimedOut
+from telegram import Update, ChatMember, ChatMemberOwner, InlineKeyboardMarkup, InlineKeyboardButton, ForceReply
+from telegram.constants import ChatType, ParseMode
+from telegram.error import BadRequest, Forbidden, TimedOut
+from telegram.request import HTTPXRequest
 
 import entities as e
+import history
 import lang
+import money
+import outbound
+import prometheus
+import sharding
+import stats
 import ton
+from cache import LRUCache
+from coalescer import Coalescer
+from dispatcher import Dispatcher
 
 logger = logging.getLogger(__name__)
-bot: Optional[Bot] = None
+bot: Optional[outbound.ScheduledBot] = None
+scheduler: Optional[outbound.Scheduler] = None
 updates_task: Optional[asyncio.Task] = None
+dispatcher: Optional[Dispatcher] = None
+inbox: Optional[asyncio.Queue] = None
+inbox_task: Optional[asyncio.Task] = None
+inbox_poll_task: Optional[asyncio.Task] = None
+# Update ids queued or being handled
+inbox_queued = set()
+inbox_pruned = 0.0
+chat_owners: Optional[LRUCache] = None
+funded_edits: Optional[Coalescer] = None
+funded_texts: Optional[LRUCache] = None
+# (label, url) of the tips buttons, urls have a {text} placeholder left for the invoice id
+keyboard: list = []
+tips_markups: Optional[LRUCache] = None
 
 TON_URL = 'ton://transfer/{address}?amount={amount}&text={text}'
 TON_URL_CUSTOM = 'ton://transfer/{address}?text={text}'
 TIPS = []
 CUSTOM_TIP = False
 HELP_URL = ''
+WORKERS = 8
+MAX_PENDING_UPDATES = 1000
+INBOX_LIMIT = 10000
+# Handled updates are kept this long, a redelivery of one within it is ignored
+INBOX_RETENTION = 24 * 3600
+INBOX_PRUNE_INTERVAL = 60
+OFFSET_KEY = 'telegram_offset'
+HANDLER_TIMEOUT = 300
+API_URL = 'https://api.telegram.org/bot'
+WEBHOOK_URL = ''
+WEBHOOK_SECRET = ''
+CHAT_OWNER_TTL = 3600
+CHAT_OWNER_CACHE_SIZE = 10000
+EDIT_WINDOW = 3.0
+RATE_LIMIT = 30
+CHAT_RATE_LIMIT = 1
+GROUP_RATE_LIMIT = 20 / 60
+CONNECTION_POOL_SIZE = 16
+ALLOWED_UPDATES = [
+    Update.CHANNEL_POST, Update.MESSAGE, Update.CALLBACK_QUERY, Update.MY_CHAT_MEMBER, Update.CHAT_MEMBER
+]
+ADMIN_STATUSES = (ChatMember.OWNER, ChatMember.ADMINISTRATOR)
 
 
 async def run(token):
-    global bot, updates_task
-    bot = Bot(token=token)
+    global bot, scheduler, updates_task, dispatcher, inbox, inbox_task, chat_owners, funded_edits, funded_texts, \
+        inbox_poll_task, inbox_queued
     await shutdown()
-    updates_task = asyncio.create_task(updates_loop())
-    logger.info('Bot is running')
+    await load_keyboard()
+    scheduler = outbound.Scheduler(rate=RATE_LIMIT, chat_rate=CHAT_RATE_LIMIT, group_rate=GROUP_RATE_LIMIT)
+    scheduler.start()
+    bot = outbound.ScheduledBot(
+        token=token,
+        base_url=API_URL,
+        request=HTTPXRequest(connection_pool_size=CONNECTION_POOL_SIZE),
+        scheduler=scheduler,
+    )
+    chat_owners = LRUCache(maxsize=CHAT_OWNER_CACHE_SIZE, ttl=CHAT_OWNER_TTL)
+    funded_edits = Coalescer(edit_funded, window=EDIT_WINDOW, name='funded')
+    funded_texts = LRUCache(maxsize=10000)
+    dispatcher = Dispatcher(
+        handle_inbox_update, workers=WORKERS, max_pending=MAX_PENDING_UPDATES, timeout=HANDLER_TIMEOUT,
+        on_done=inbox_done, name='updates',
+    )
+    dispatcher.start()
+    inbox = asyncio.Queue()
+    inbox_queued = set()
+    if sharding.sharded():
+        inbox_poll_task = asyncio.create_task(sharding.poll('inbox', owned_updates, inbox_queued, queue_stored_update))
+    else:
+        stored = await e.objects.execute(
+            e.InboxUpdate.select().where(e.InboxUpdate.done.is_null()).order_by(e.InboxUpdate.update_id)
+        )
+        for row in stored:
+            inbox_queued.add(row.update_id)
+            inbox.put_nowait((row.update_id, json.loads(row.data)))
+        if stored:
+            logger.info('Resuming %d updates from the inbox', len(stored))
+    inbox_task = asyncio.create_task(inbox_loop())
+    if not sharding.leader():
+        logger.info('Bot is running, process %d of %d', sharding.INDEX, sharding.COUNT)
+    elif WEBHOOK_URL:
+        await bot.set_webhook(
+            url=f'{WEBHOOK_URL}/telegram/{WEBHOOK_SECRET}',
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+        logger.info('Bot is running with webhook')
+    else:
+        await bot.delete_webhook()
+        updates_task = asyncio.create_task(updates_loop())
+        logger.info('Bot is running')
 
 
 async def shutdown():
-    if not isinstance(updates_task, asyncio.Task):
+    global updates_task, inbox_task, inbox_poll_task, dispatcher
+    if isinstance(updates_task, asyncio.Task):
+        updates_task.cancel()
+        await asyncio.gather(updates_task, return_exceptions=True)
+        updates_task = None
+    if isinstance(inbox_poll_task, asyncio.Task):
+        inbox_poll_task.cancel()
+        await asyncio.gather(inbox_poll_task, return_exceptions=True)
+        inbox_poll_task = None
+    if isinstance(inbox_task, asyncio.Task):
+        inbox_task.cancel()
+        await asyncio.gather(inbox_task, return_exceptions=True)
+        inbox_task = None
+    if dispatcher is None:
         return
-    updates_task.cancel()
-    await updates_task
+    await dispatcher.close()
+    await funded_edits.close()
+    await scheduler.close()
+    dispatcher = None
     logger.info('Bot is terminated')
 
 
+def update_chat_id(update):
+    if update.channel_post:
+        return update.channel_post.chat.id
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    if update.my_chat_member:
+        return update.my_chat_member.chat.id
+    if update.chat_member:
+        return update.chat_member.chat.id
+    return None
+
+
+async def handle_update(update):
+    if update.channel_post:
+        await handle_channel_post(update.channel_post)
+    elif update.message:
+        await handle_message(update.message)
+    elif update.callback_query:
+        await handle_callback_query(update.callback_query)
+        await bot.answer_callback_query(update.callback_query.id)
+    elif update.my_chat_member:
+        await forget_chat_owner(update.my_chat_member.chat.id)
+    elif update.chat_member:
+        await handle_chat_member(update.chat_member)
+
+
+def inbox_full():
+    return inbox.qsize() >= INBOX_LIMIT
+
+
+def raw_chat_id(data):
+    try:
+        return update_chat_id(Update.de_json(data, bot))
+    except Exception:
+        return None
+
+
+async def append_updates(updates, offset=None):
+    """Durably store raw updates, together with the polling offset that confirms them, and queue the new ones.
+
+    Updates already in the inbox, pending or handled, are redeliveries and are dropped. With several processes, updates
+    are queued by the process owning their chat when it polls the inbox.
+    """
+    sharded = sharding.sharded()
+    async with e.objects.atomic():
+        stored = {update_id for update_id, in await e.objects.execute(e.InboxUpdate.select(
+            e.InboxUpdate.update_id
+        ).where(e.InboxUpdate.update_id.in_([update['update_id'] for update in updates])).tuples())}
+        updates = [update for update in updates if update['update_id'] not in stored]
+        if updates:
+            await e.objects.execute(e.InboxUpdate.insert_many([{
+                'update_id': update['update_id'],
+                'data': json.dumps(update),
+                'chat_id': raw_chat_id(update) if sharded else None,
+            } for update in updates]).on_conflict_ignore())
+        if offset is not None:
+            await e.objects.execute(e.Setting.insert(key=OFFSET_KEY, value=str(offset)).on_conflict(
+                conflict_target=[e.Setting.key], update={e.Setting.value: str(offset)},
+            ))
+    if not sharded:
+        for update in updates:
+            # Another append of the same update may have committed meanwhile
+            if update['update_id'] not in inbox_queued:
+                inbox_queued.add(update['update_id'])
+                inbox.put_nowait((update['update_id'], update))
+
+
+async def owned_updates():
+    rows = await e.objects.execute(e.InboxUpdate.select(e.InboxUpdate.update_id).where(
+        e.InboxUpdate.done.is_null(), sharding.owned(e.InboxUpdate.chat_id)
+    ).order_by(e.InboxUpdate.update_id).limit(INBOX_LIMIT))
+    return [row.update_id for row in rows]
+
+
+async def queue_stored_update(update_id):
+    try:
+        row = await e.objects.get(e.InboxUpdate, update_id=update_id)
+    except e.InboxUpdate.DoesNotExist:
+        row = None
+    if row is None or row.done is not None:
+        # Handled while the poll that found it was in flight
+        inbox_queued.discard(update_id)
+        return
+    inbox.put_nowait((update_id, json.loads(row.data)))
+
+
+async def feed_update(data):
+    await append_updates([data])
+
+
 async def updates_loop():
-    offset = None
+    offset = await e.objects.scalar(e.Setting.select(e.Setting.value).where(e.Setting.key == OFFSET_KEY))
+    offset = offset and int(offset)
     while True:
         try:
-            updates = await bot.get_updates(offset=offset, timeout=60, allowed_updates=[
-                Update.CHANNEL_POST, Update.MESSAGE, Update.CALLBACK_QUERY
-            ])
-            for update in updates:
-                offset = update.update_id + 1
-                if update.channel_post:
-                    await handle_channel_post(update.channel_post)
-                elif update.message:
-                    await handle_message(update.message)
-                elif update.callback_query:
-                    await handle_callback_query(update.callback_query)
-                    await bot.answer_callback_query(update.callback_query.id)
+            if inbox_full():
+                await asyncio.sleep(1)
+                continue
+            updates = await bot.get_updates(offset=offset, timeout=60, allowed_updates=ALLOWED_UPDATES)
+            if updates:
+                next_offset = updates[-1].update_id + 1
+                await append_updates([update.to_dict() for update in updates], next_offset)
+                offset = next_offset
         except TimedOut:
             pass
         except asyncio.CancelledError:
@@ -66,51 +263,147 @@ async def updates_loop():
             await asyncio.sleep(1)
 
 
+async def inbox_loop():
+    """Hand inbox updates to the dispatcher, waiting while it is full."""
+    while True:
+        update_id, data = await inbox.get()
+        try:
+            update = Update.de_json(data, bot)
+        except Exception as err:
+            logger.exception('Malformed update %s: %r', update_id, err)
+            await inbox_done((update_id, None))
+            continue
+        await dispatcher.put(update_chat_id(update), (update_id, update))
+
+
+async def handle_inbox_update(item):
+    await handle_update(item[1])
+
+
+async def inbox_done(item):
+    global inbox_pruned
+    await e.objects.execute(e.InboxUpdate.update(done=ton.now_utc()).where(e.InboxUpdate.update_id == item[0]))
+    inbox_queued.discard(item[0])
+    if time.monotonic() - inbox_pruned > INBOX_PRUNE_INTERVAL:
+        inbox_pruned = time.monotonic()
+        await e.objects.execute(e.InboxUpdate.delete().where(
+            e.InboxUpdate.done < ton.now_utc() - timedelta(seconds=INBOX_RETENTION)
+        ))
+
+
+class NoChatOwner(Exception):
+    """The bot can see the chat, but not its owner."""
+
+
+# Errors of get_chat_owner that retrying won't fix
+OWNER_UNAVAILABLE = (Forbidden, BadRequest, NoChatOwner)
+
+
 async def get_chat_owner(chat_id):
+    return await chat_owners.get_or_load(chat_id, functools.partial(load_chat_owner, chat_id))
+
+
+async def load_chat_owner(chat_id):
+    chat = await e.objects.execute(e.Chat.select().where(e.Chat.id == chat_id))
+    if chat and time.time() - chat[0].updated.timestamp() < CHAT_OWNER_TTL:
+        return chat[0].owner_id
     admins = await bot.get_chat_administrators(chat_id)
-    return [admin.user.id for admin in admins if isinstance(admin, ChatMemberOwner)][0]
+    owners = [admin.user.id for admin in admins if isinstance(admin, ChatMemberOwner)]
+    if not owners:
+        raise NoChatOwner(chat_id)
+    owner_id = owners[0]
+    updated = ton.now_utc()
+    await e.objects.execute(e.Chat.insert(id=chat_id, owner_id=owner_id, updated=updated).on_conflict(
+        conflict_target=[e.Chat.id], update={e.Chat.owner_id: owner_id, e.Chat.updated: updated},
+    ))
+    return owner_id
 
 
-async def gen_tips_message(invoice_id, funded):
+async def forget_chat_owner(chat_id):
+    chat_owners.pop(chat_id)
+    await e.objects.execute(e.Chat.delete().where(e.Chat.id == chat_id))
+
+
+@prometheus.handler_seconds.timed('chat_member')
+async def handle_chat_member(chat_member):
+    if chat_member.old_chat_member.status in ADMIN_STATUSES or chat_member.new_chat_member.status in ADMIN_STATUSES:
+        await forget_chat_owner(chat_member.chat.id)
+
+
+async def load_keyboard():
+    """Build the tips buttons for the current wallet, call again after the wallet changes."""
+    global keyboard, tips_markups
     wallet = await e.objects.scalar(e.Wallet.select(e.Wallet.address))
-    buttons = [
-        InlineKeyboardButton(text, TON_URL.format(address=wallet, amount=amount, text=invoice_id))
-        for text, amount in TIPS
-    ]
+    if wallet is None:
+        logger.warning('There is no wallet to receive tips')
+    buttons = [(text, TON_URL.format(address=wallet, amount=amount, text='{text}')) for text, amount in TIPS]
     if CUSTOM_TIP:
-        buttons += [InlineKeyboardButton(lang.CUSTOM_TIP, TON_URL_CUSTOM.format(address=wallet, text=invoice_id))]
-    if HELP_URL:
-        buttons += [InlineKeyboardButton(lang.HELP_BUTTON, HELP_URL)]
-    markup = InlineKeyboardMarkup([buttons])
-    text = lang.TIPS_TEXT_BOTTOM.format(amount=ton.int_to_ton(funded))
-    return text, markup
+        buttons += [(lang.CUSTOM_TIP, TON_URL_CUSTOM.format(address=wallet, text='{text}'))]
+    keyboard = buttons
+    tips_markups = LRUCache(maxsize=10000)
+    logger.info('Tips keyboard is loaded for %s', wallet)
+
+
+def tips_markup(invoice_id):
+    markup = tips_markups.get(invoice_id)
+    if markup is None:
+        buttons = [InlineKeyboardButton(text, url.format(text=invoice_id)) for text, url in keyboard]
+        if HELP_URL:
+            buttons += [InlineKeyboardButton(lang.HELP_BUTTON, HELP_URL)]
+        markup = InlineKeyboardMarkup([buttons])
+        tips_markups.set(invoice_id, markup)
+    return markup
 
 
+def gen_tips_message(invoice_id, funded):
+    text = lang.TIPS_TEXT_BOTTOM.format(amount=money.display(funded))
+    return text, tips_markup(invoice_id)
+
+
+@prometheus.handler_seconds.timed('channel_post')
 async def handle_channel_post(channel_post):
     if channel_post.reply_to_message:
         return
     invoice_id = await ton.gen_invoice_id(channel_post.chat.id, channel_post.message_id)
-    text, markup = await gen_tips_message(invoice_id, 0)
+    invoice = await e.objects.get(e.Invoice, id=invoice_id)
+    if invoice.message_id != channel_post.message_id:
+        # Handled again from the inbox, the tips message was sent already
+        return
+    text, markup = gen_tips_message(invoice_id, invoice.funded)
     tips_msg = await bot.send_message(
         channel_post.chat.id, text=text,
         parse_mode=ParseMode.MARKDOWN,
         reply_markup=markup,
     )
+    funded_texts.set(invoice_id, text)
     await e.objects.execute(e.Invoice.update(message_id=tips_msg.id).where(e.Invoice.id == invoice_id))
 
 
 async def update_funded(invoice_id):
-    invoice = await e.objects.get(e.Invoice, id=invoice_id)
-    text, markup = await gen_tips_message(invoice_id, invoice.funded)
-    await bot.edit_message_text(
-        text=text,
-        parse_mode=ParseMode.MARKDOWN,
-        chat_id=invoice.chat_id,
-        message_id=invoice.message_id,
-        reply_markup=markup,
-    )
+    funded_edits.schedule(invoice_id)
 
 
+async def edit_funded(invoice_id):
+    invoice = await e.objects.get(e.Invoice, id=invoice_id)
+    text, markup = gen_tips_message(invoice_id, invoice.funded)
+    if funded_texts.get(invoice_id) == text:
+        return
+    try:
+        with outbound.priority(outbound.LOW):
+            await bot.edit_message_text(
+                text=text,
+                parse_mode=ParseMode.MARKDOWN,
+                chat_id=invoice.chat_id,
+                message_id=invoice.message_id,
+                reply_markup=markup,
+            )
+    except BadRequest as err:
+        if 'not modified' not in err.message:
+            raise
+    funded_texts.set(invoice_id, text)
+
+
+@prometheus.handler_seconds.timed('message')
 async def handle_message(message):
     if message.reply_to_message:
         return await handle_reply(message)
@@ -122,16 +415,57 @@ async def handle_message(message):
         )
     elif message.text.startswith('/balance'):
         balance = await ton.get_user_available_balance(message.from_user.id)
-        await bot.send_message(
-            text=lang.BALANCE_MESSAGE.format(amount=balance),
-            parse_mode=ParseMode.MARKDOWN,
-            chat_id=message.chat.id,
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton(lang.WITHDRAW_BUTTON, callback_data=WithdrawButton(None).data)
-            ]])
-        )
+        with outbound.priority(outbound.HIGH):
+            await bot.send_message(
+                text=lang.BALANCE_MESSAGE.format(amount=money.display(balance)),
+                parse_mode=ParseMode.MARKDOWN,
+                chat_id=message.chat.id,
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton(lang.WITHDRAW_BUTTON, callback_data=WithdrawButton(None).data)
+                ]])
+            )
+    elif message.text.startswith('/history') and message.chat.type == ChatType.PRIVATE:
+        await send_history_links(message)
+    elif message.text.startswith('/stats') and message.chat.type == ChatType.PRIVATE:
+        await send_stats(message)
+
+
+async def send_history_links(message):
+    """Signed export links for the user's own history and for every chat they own."""
+    if not history.enabled():
+        await bot.send_message(text=lang.HISTORY_UNAVAILABLE, chat_id=message.chat.id)
+        return
+    user_id = message.from_user.id
+    lines = [lang.HISTORY_USER.format(**history.links(history.USER, user_id))]
+    lines += [
+        lang.HISTORY_CHAT.format(chat_id=chat_id, **history.links(history.CHAT, chat_id))
+        for chat_id in await stats.owned_chats(user_id)
+    ]
+    await bot.send_message(text='\n'.join(lines), chat_id=message.chat.id, disable_web_page_preview=True)
+
+
+async def send_stats(message):
+    """Totals of the chats the user owns, with a link to their JSON for dashboards when links are enabled."""
+    paragraphs = []
+    for chat_id in await stats.owned_chats(message.from_user.id):
+        summary = await stats.chat_summary(chat_id)
+        lines = [lang.STATS_CHAT.format(
+            chat_id=chat_id, tips=summary['tips'], amount=money.display(summary['amount']),
+            today=money.display(summary['today']['amount']),
+        )]
+        lines += [
+            lang.STATS_TOP.format(message_id=top['message_id'], amount=money.display(top['amount']))
+            for top in summary['top']
+        ]
+        if history.enabled():
+            lines.append(stats.link(chat_id))
+        paragraphs.append('\n'.join(lines))
+    await bot.send_message(
+        text='\n\n'.join(paragraphs) or lang.STATS_NONE, chat_id=message.chat.id, disable_web_page_preview=True
+    )
 
 
+@prometheus.handler_seconds.timed('reply')
 async def handle_reply(message):
     if ' ' not in message.text:
         await bot.send_message(
@@ -145,16 +479,19 @@ async def handle_reply(message):
     re_amount = re.compile(r'^\d+(\.\d+)?$')
     if re_amount.match(address):
         address, amount = amount, address
-    if not re_amount.match(amount):
+    if not ton.valid_address(address):
         await bot.send_message(
-            text=lang.INCORRECT_AMOUNT,
+            text=lang.INCORRECT_ADDRESS,
             parse_mode=ParseMode.MARKDOWN,
             chat_id=message.chat.id,
             reply_to_message_id=message.message_id,
         )
         return
-    amount = Decimal(amount)
-    if amount < ton.MIN_WITHDRAW:
+    try:
+        amount = money.to_nano(amount)
+    except ValueError:
+        amount = None
+    if amount is None or amount < ton.MIN_WITHDRAW:
         await bot.send_message(
             text=lang.INCORRECT_AMOUNT,
             parse_mode=ParseMode.MARKDOWN,
@@ -162,6 +499,9 @@ async def handle_reply(message):
             reply_to_message_id=message.message_id,
         )
         return
+    if await ton.withdrawal_requested(message.chat.id, message.message_id):
+        # Handled again after a crash, before the update was marked done
+        return
     if amount > await ton.get_user_available_balance(message.from_user.id):
         await bot.send_message(
             text=lang.NOT_ENOUGH_FUNDS,
@@ -176,13 +516,39 @@ async def handle_reply(message):
         chat_id=message.chat.id,
         reply_to_message_id=message.message_id,
     )
-    await ton.withdraw(user_id=message.from_user.id, address=address, amount=amount)
-    await bot.edit_message_text(
-        text=lang.WITHDRAW_EXECUTED,
-        parse_mode=ParseMode.MARKDOWN,
-        chat_id=wait_message.chat.id,
-        message_id=wait_message.message_id,
-    )
+    try:
+        await ton.withdraw(
+            user_id=message.from_user.id, address=address, amount=amount,
+            chat_id=wait_message.chat.id, message_id=wait_message.message_id,
+            request_chat_id=message.chat.id, request_message_id=message.message_id,
+        )
+    except ton.DuplicateWithdrawal:
+        await bot.delete_message(chat_id=wait_message.chat.id, message_id=wait_message.message_id)
+    except ton.InsufficientFunds:
+        # Another withdrawal got to the balance between the check above and the debit
+        await bot.edit_message_text(
+            text=lang.NOT_ENOUGH_FUNDS,
+            parse_mode=ParseMode.MARKDOWN,
+            chat_id=wait_message.chat.id,
+            message_id=wait_message.message_id,
+        )
+
+
+async def update_withdrawal(withdrawal):
+    text = {
+        e.Withdrawal.CONFIRMED: lang.WITHDRAW_EXECUTED,
+        e.Withdrawal.FAILED: lang.WITHDRAW_FAILED,
+        e.Withdrawal.SENT: lang.WITHDRAW_UNCONFIRMED,
+    }[withdrawal.state]
+    if withdrawal.chat_id is None:
+        return
+    with outbound.priority(outbound.HIGH):
+        await bot.edit_message_text(
+            text=text,
+            parse_mode=ParseMode.MARKDOWN,
+            chat_id=withdrawal.chat_id,
+            message_id=withdrawal.message_id,
+        )
 
 
 class Button:
@@ -224,6 +590,7 @@ class WithdrawButton(Button):
 BUTTONS = [WithdrawButton]
 
 
+@prometheus.handler_seconds.timed('callback_query')
 async def handle_callback_query(callback_query):
     data = base64.b64decode(callback_query.data)
     button_id = data[0]
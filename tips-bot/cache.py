@@ -0,0 +1,103 @@
+import asyncio
+import collections
+import time
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Bounded mapping with least-recently-used eviction and an optional TTL.
+
+    ``get_or_load`` shares one loader call between concurrent misses of the same key.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._loading = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not _MISSING
+
+    def _lookup(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return _MISSING
+        expires, value = item
+        if expires is not None and expires <= time.monotonic():
+            del self._data[key]
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        """Like get, but doesn't count as a hit or refresh the entry."""
+        item = self._data.get(key)
+        if item is None or item[0] is not None and item[0] <= time.monotonic():
+            return default
+        return item[1]
+
+    def keys(self):
+        return list(self._data)
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        self._loading.pop(key, None)
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+        self._loading.clear()
+
+    async def get_or_load(self, key, loader):
+        value = self._lookup(key)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+        future = self._loading.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self._loading[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as err:
+            future.set_exception(err)
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            if self._loading.get(key) is future:
+                self.set(key, value)
+            return value
+        finally:
+            if self._loading.get(key) is future:
+                del self._loading[key]
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import RetryAfter
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class Coalescer:
+    """Collapses repeated requests for a key into at most one handler call per window.
+
+    The handler is expected to read the latest state itself, so requests arriving while a call is pending are
+    simply absorbed by it. ``RetryAfter`` from Telegram postpones the call instead of failing it.
+    """
+
+    def __init__(self, handler, *, window=3.0, maxsize=10000, name='coalescer'):
+        self.handler = handler
+        self.window = window
+        self.name = name
+        self.scheduled = 0
+        self.calls = 0
+        self._tasks = {}
+        self._dirty = set()
+        self._last_call = LRUCache(maxsize=maxsize, ttl=window)
+
+    def schedule(self, key):
+        self.scheduled += 1
+        self._dirty.add(key)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._run(key))
+
+    async def _run(self, key):
+        try:
+            while key in self._dirty:
+                last_call = self._last_call.get(key)
+                if last_call is not None:
+                    await asyncio.sleep(last_call + self.window - time.monotonic())
+                self._dirty.discard(key)
+                self._last_call.set(key, time.monotonic())
+                self.calls += 1
+                try:
+                    await self.handler(key)
+                except RetryAfter as err:
+                    logger.warning('%s: retry %r after %s seconds', self.name, key, err.retry_after)
+                    self._dirty.add(key)
+                    await asyncio.sleep(err.retry_after)
+                except Exception as err:
+                    logger.exception('%s: handler exception for %r: %r', self.name, key, err)
+        finally:
+            del self._tasks[key]
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._dirty.clear()
@@ -0,0 +1,104 @@
+import asyncio
+import collections
+import logging
+
+import prometheus
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    """Runs a handler for queued items on a bounded pool of workers.
+
+    Items sharing a key are handled strictly one after another in the order
+    they were put, items with different keys are handled concurrently.
+    ``on_done`` is awaited for every item once its handler returned, failed
+    or timed out, but not for items interrupted by ``close``.
+    """
+
+    def __init__(self, handler, *, workers=8, max_pending=1000, timeout=None, on_done=None, name='dispatcher'):
+        self.handler = handler
+        self.on_done = on_done
+        self.workers = workers
+        self.timeout = timeout
+        self.name = name
+        self._queues = {}
+        self._ready = asyncio.Queue()
+        self._slots = asyncio.Semaphore(max_pending)
+        self._max_pending = max_pending
+        self._tasks = []
+        self.pending = 0
+        self.processed = 0
+        self.failed = 0
+        self.timed_out = 0
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def put(self, key, item):
+        """Hand an item off to the dispatcher, waiting while it is full."""
+        await self._slots.acquire()
+        self.pending += 1
+        queue = self._queues.get(key)
+        if queue is None:
+            self._queues[key] = collections.deque([item])
+            self._ready.put_nowait(key)
+        else:
+            queue.append(item)
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            item = queue.popleft()
+            try:
+                try:
+                    await asyncio.wait_for(self.handler(item), self.timeout)
+                    self.processed += 1
+                except asyncio.TimeoutError:
+                    self.timed_out += 1
+                    prometheus.errors.inc(self.name)
+                    logger.error('%s: handler timed out for %r', self.name, key)
+                except Exception as err:
+                    self.failed += 1
+                    prometheus.errors.inc(self.name)
+                    logger.exception('%s: handler exception for %r: %r', self.name, key, err)
+                if self.on_done is not None:
+                    await self.on_done(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logger.exception('%s: on_done exception for %r: %r', self.name, key, err)
+            finally:
+                self.pending -= 1
+                self._slots.release()
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._queues[key]
+
+    async def join(self):
+        while self.pending:
+            await asyncio.sleep(0.1)
+
+    async def close(self, timeout=5):
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning('%s: dropping %d pending items', self.name, self.pending)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def metrics(self):
+        return {
+            'workers': self.workers,
+            'pending': self.pending,
+            'max_pending': self._max_pending,
+            'keys': len(self._queues),
+            'ready': self._ready.qsize(),
+            'processed': self.processed,
+            'failed': self.failed,
+            'timed_out': self.timed_out,
+        }
@@ -1,14 +1,30 @@
 from datetime import datetime
 
-from peewee import IntegerField, Model, TextField, AutoField, ForeignKeyField
-from peewee_async import Manager
+from peewee import BigIntegerField, CompositeKey, DatabaseProxy, IntegerField, Model, TextField, AutoField, \
+    ForeignKeyField
+from peewee_async import Manager, PooledPostgresqlDatabase
 
 from async_sqlite import SqliteDatabase
 
-database = SqliteDatabase(None)
+SQLITE = 'sqlite'
+POSTGRES = 'postgres'
+
+database = DatabaseProxy()
 objects = Manager(database)
 
 
+def init_database(name, backend=SQLITE, **kwargs):
+    """Select the database: a file name for sqlite, a database name and connection parameters for postgres."""
+    if backend == SQLITE:
+        selected = SqliteDatabase(name, **kwargs)
+    elif backend == POSTGRES:
+        selected = PooledPostgresqlDatabase(name, **kwargs)
+    else:
+        raise ValueError(f'Unknown database backend: {backend}')
+    database.initialize(selected)
+    return selected
+
+
 class UTCDateTimeField(IntegerField):
     def db_value(self, value):
         if not value:
@@ -29,14 +45,18 @@ class BaseModel(Model):
 
 class Invoice(BaseModel):
     id = TextField(primary_key=True)
-    chat_id = IntegerField()
+    chat_id = BigIntegerField()
     message_id = IntegerField()
-    funded = IntegerField()
-    message = TextField()
-    entities = TextField()
+    funded = BigIntegerField(default=0)
+    message = TextField(default='')
+    entities = TextField(default='')
 
     class Meta:
         db_table = 'invoice'
+        indexes = (
+            (('chat_id', 'message_id'), False),
+            (('chat_id', 'funded'), False),
+        )
 
     def __repr__(self):
         return f'Invoice(id={self.id}, chat_id={self.chat_id}, message_id={self.message_id}), fuded={self.funded}, ' \
@@ -44,9 +64,9 @@ class Invoice(BaseModel):
 
 
 class Wallet(BaseModel):
-    id = TextField(primary_key=True)
-    address = TextField()
-    private_key = TextField()
+    id = AutoField(primary_key=True)
+    address = TextField(index=True)
+    private_key = TextField(null=True)
     state = TextField(null=True)
 
     class Meta:
@@ -58,24 +78,168 @@ class Wallet(BaseModel):
 
 class Transaction(BaseModel):
     rowid = AutoField(primary_key=True)
-    user_id = IntegerField()
+    user_id = BigIntegerField()
     date = UTCDateTimeField()
-    amount = IntegerField()
+    amount = BigIntegerField()
     wallet = ForeignKeyField(model=Wallet, column_name='wallet_id', field='id', index=True)
-    invoice = ForeignKeyField(null=True, model=Invoice, column_name='invoice_id', field='id')
+    invoice = ForeignKeyField(null=True, model=Invoice, column_name='invoice_id', field='id', index=False)
+    # The invoice's chat, copied for chat history pages to go by rowid over their own index
+    chat_id = BigIntegerField(null=True)
     seqno = TextField(null=True)
+    # Chain identity of an incoming payment
+    lt = TextField(null=True)
+    hash = TextField(null=True, unique=True)
 
     class Meta:
         db_table = 'transaction'
+        # History pages go by rowid, date is there to filter them without reading the rows
+        indexes = (
+            (('user_id', 'rowid', 'date'), False),
+            (('invoice', 'rowid', 'date'), False),
+            (('chat_id', 'rowid', 'date'), False),
+        )
 
     def __repr__(self):
         return f'Transaction(rowid={self.rowid}, user_id={self.user_id}, date={self.date}, amount={self.amount}, ' \
-               f'wallet={self.wallet}, invoice={self.invoice}, seqno={self.seqno})'
+               f'wallet={self.wallet}, invoice={self.invoice}, chat_id={self.chat_id}, seqno={self.seqno}, ' \
+               f'lt={self.lt}, hash={self.hash})'
+
+
+class Withdrawal(BaseModel):
+    PENDING = 'pending'
+    SENT = 'sent'
+    CONFIRMED = 'confirmed'
+    FAILED = 'failed'
+
+    id = AutoField(primary_key=True)
+    transaction = ForeignKeyField(model=Transaction, column_name='transaction_id', field='rowid')
+    address = TextField()
+    state = TextField(default=PENDING, index=True)
+    chat_id = BigIntegerField(null=True)
+    message_id = IntegerField(null=True)
+    updated = UTCDateTimeField()
+    error = TextField(null=True)
+    # The user's message asking for it, a message is never executed twice
+    request_chat_id = BigIntegerField(null=True)
+    request_message_id = BigIntegerField(null=True)
+
+    class Meta:
+        db_table = 'withdrawal'
+        indexes = (
+            (('request_chat_id', 'request_message_id'), True),
+        )
+
+    def __repr__(self):
+        return f'Withdrawal(id={self.id}, transaction={self.transaction}, address={self.address}, ' \
+               f'state={self.state}, chat_id={self.chat_id}, message_id={self.message_id}, updated={self.updated}, ' \
+               f'error={self.error}, request_chat_id={self.request_chat_id}, ' \
+               f'request_message_id={self.request_message_id})'
+
+
+class Chat(BaseModel):
+    id = BigIntegerField(primary_key=True)
+    owner_id = BigIntegerField()
+    updated = UTCDateTimeField()
+
+    class Meta:
+        db_table = 'chat'
+
+    def __repr__(self):
+        return f'Chat(id={self.id}, owner_id={self.owner_id}, updated={self.updated})'
+
+
+class TrackingBatch(BaseModel):
+    """Payments acknowledged to the gateway but not processed yet."""
+    id = AutoField(primary_key=True)
+    address = TextField()
+    payments = TextField()
+    received = UTCDateTimeField()
+    # Set when the payments are split by chat between processes
+    chat_id = BigIntegerField(null=True)
+
+    class Meta:
+        db_table = 'tracking_batch'
+
+    def __repr__(self):
+        return f'TrackingBatch(id={self.id}, address={self.address}, payments={self.payments}, ' \
+               f'received={self.received}, chat_id={self.chat_id})'
+
+
+class ParkedPayment(BaseModel):
+    """Payment that couldn't be credited, kept for a manual check."""
+    id = AutoField(primary_key=True)
+    address = TextField()
+    payment = TextField()
+    chat_id = BigIntegerField(null=True)
+    hash = TextField(null=True, unique=True)
+    error = TextField()
+    parked = UTCDateTimeField()
+
+    class Meta:
+        db_table = 'parked_payment'
+
+    def __repr__(self):
+        return f'ParkedPayment(id={self.id}, address={self.address}, payment={self.payment}, ' \
+               f'chat_id={self.chat_id}, hash={self.hash}, error={self.error}, parked={self.parked})'
+
+
+class InboxUpdate(BaseModel):
+    """Telegram update received, kept for a while after it is handled so a redelivery of it is recognized."""
+    update_id = BigIntegerField(primary_key=True)
+    data = TextField()
+    chat_id = BigIntegerField(null=True)
+    done = UTCDateTimeField(null=True, index=True)
+
+    class Meta:
+        db_table = 'inbox_update'
+
+    def __repr__(self):
+        return f'InboxUpdate(update_id={self.update_id}, data={self.data}, chat_id={self.chat_id}, done={self.done})'
+
+
+class Setting(BaseModel):
+    key = TextField(primary_key=True)
+    value = TextField()
+
+    class Meta:
+        db_table = 'setting'
+
+    def __repr__(self):
+        return f'Setting(key={self.key}, value={self.value})'
+
+
+class ChatStats(BaseModel):
+    """Tip totals of a chat, updated in the transaction storing the tips."""
+    chat_id = BigIntegerField(primary_key=True)
+    owner_id = BigIntegerField(index=True)
+    tips = IntegerField(default=0)
+    amount = BigIntegerField(default=0)
+
+    class Meta:
+        db_table = 'chat_stats'
+
+    def __repr__(self):
+        return f'ChatStats(chat_id={self.chat_id}, owner_id={self.owner_id}, tips={self.tips}, amount={self.amount})'
+
+
+class ChatDay(BaseModel):
+    """Tip totals of a chat for one UTC day, day is the number of days since the epoch."""
+    chat_id = BigIntegerField()
+    day = IntegerField()
+    tips = IntegerField(default=0)
+    amount = BigIntegerField(default=0)
+
+    class Meta:
+        db_table = 'chat_day'
+        primary_key = CompositeKey('chat_id', 'day')
+
+    def __repr__(self):
+        return f'ChatDay(chat_id={self.chat_id}, day={self.day}, tips={self.tips}, amount={self.amount})'
 
 
 class User(BaseModel):
-    id = IntegerField(primary_key=True)
-    balance = IntegerField(default=0)
+    id = BigIntegerField(primary_key=True)
+    balance = BigIntegerField(default=0)
 
     class Meta:
         db_table = 'user'
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Local stand-in for the TON gateway (ton-interaction/track_server).
+
+Point the bot at it with ``"ton_gateway": "http://127.0.0.1:7000"``. Transfers are recorded in ``sent`` and confirmed
+with a per-wallet seqno after ``send_delay`` seconds, ``pay`` delivers a payment to the bot's ``/tracking`` callback
+and ``redeliver`` repeats a delivered callback the way the real gateway does after a timeout or restart.
+"""
+import argparse
+import asyncio
+import collections
+import hashlib
+import itertools
+import logging
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class FakeGateway:
+    def __init__(self, host='127.0.0.1', port=7000, send_delay=0.0, max_batch=4):
+        self.host = host
+        self.port = port
+        self.send_delay = send_delay
+        self.max_batch = max_batch
+        self.fail_next = 0
+        self.tracking = {}
+        self.delivered = []
+        self.sent = []
+        self.seqnos = collections.Counter()
+        self._lts = itertools.count(1)
+        self._in_flight = set()
+        self.app = web.Application()
+        self.app.router.add_post('/startPaymentTracking', self.handle_tracking)
+        self.app.router.add_post('/send', self.handle_send)
+        self.app.router.add_post('/sendBatch', self.handle_send_batch)
+        self.runner = web.AppRunner(self.app, lingering_time=0)
+        self.session = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    async def start(self):
+        self.session = aiohttp.ClientSession()
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host=self.host, port=self.port).start()
+        logger.info('Fake gateway is running on %s', self.url)
+
+    async def stop(self):
+        await self.runner.cleanup()
+        await self.session.close()
+
+    async def handle_tracking(self, request):
+        data = await request.json()
+        self.tracking[data['address']] = data['callbackUrl']
+        return web.Response(text='OK')
+
+    async def transfer(self, source, messages):
+        if source in self._in_flight:
+            raise web.HTTPInternalServerError(text='Parallel transfers are not allowed')
+        self._in_flight.add(source)
+        try:
+            await asyncio.sleep(self.send_delay)
+            if self.fail_next:
+                self.fail_next -= 1
+                raise web.HTTPBadRequest(text='Transfer unsuccessfull')
+            seqno = self.seqnos[source]
+            self.seqnos[source] += 1
+            self.sent.append((source, seqno, messages))
+            return {'seqno': seqno}
+        finally:
+            self._in_flight.discard(source)
+
+    async def handle_send(self, request):
+        data = await request.json()
+        result = await self.transfer(data['sourceAddress'], [{
+            'destinationAddress': data['destinationAddress'],
+            'amount': data['amount'],
+            'message': data.get('message'),
+        }])
+        return web.json_response(result)
+
+    async def handle_send_batch(self, request):
+        data = await request.json()
+        messages = data['messages']
+        if not messages or len(messages) > self.max_batch:
+            raise web.HTTPInternalServerError(text=f'At most {self.max_batch} messages are allowed')
+        result = await self.transfer(data['sourceAddress'], messages)
+        result['results'] = [
+            {'index': index, 'destinationAddress': m['destinationAddress'], 'amount': m['amount']}
+            for index, m in enumerate(messages)
+        ]
+        return web.json_response(result)
+
+    async def pay(self, address, payments):
+        """Deliver payments, a list of (invoice_id, amount), to the wallet's tracking callback."""
+        data = {'address': address, 'payments': []}
+        for invoice_id, amount in payments:
+            lt = str(next(self._lts))
+            data['payments'].append({
+                'source': 'EQ_fake_source',
+                'amount': amount,
+                'message': invoice_id,
+                'lt': lt,
+                'hash': hashlib.sha256(f'{address}:{lt}'.encode()).hexdigest(),
+            })
+        data['nextTrackingState'] = {'lastProcessedLt': str(next(self._lts))}
+        self.delivered.append(data)
+        return await self.deliver(data)
+
+    async def redeliver(self, index=-1):
+        return await self.deliver(self.delivered[index])
+
+    async def deliver(self, data):
+        async with self.session.post(self.tracking[data['address']], json=data) as resp:
+            return resp.status, await resp.text()
+
+
+async def main(host, port, send_delay):
+    fake = FakeGateway(host, port, send_delay)
+    await fake.start()
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('host', type=str, default='127.0.0.1', nargs='?')
+    parser.add_argument('port', type=int, default=7000, nargs='?')
+    parser.add_argument('--send-delay', type=float, default=0.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(args.host, args.port, args.send_delay))
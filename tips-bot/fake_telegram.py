@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Local stand-in for the Telegram Bot API.
+
+Point the bot at it with ``"bot_api_url": "http://127.0.0.1:8081/bot"`` in the config. Every call is recorded in
+``calls`` as (method, params, time.perf_counter()), updates added with ``add_update`` (timed in ``added``) are served
+by ``getUpdates`` or, when a webhook is set, posted to the bot's ``/telegram/<secret>`` route. With ``flood_rate``
+that share of sends and edits is answered with 429 Too Many Requests, like the real API does under load.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class FakeTelegram:
+    FLOODED_METHODS = ('sendMessage', 'editMessageText')
+
+    def __init__(self, host='127.0.0.1', port=8081, owner_id=1, flood_rate=0.0, retry_after=1):
+        self.host = host
+        self.port = port
+        self.owner_id = owner_id
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.flooded = 0
+        self.calls = []
+        self.updates = []
+        self.added = {}
+        self.webhook = None
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+        self.app = web.Application()
+        self.app.router.add_post(r'/bot{token}/{method}', self.handle)
+        self.runner = web.AppRunner(self.app, lingering_time=0)
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}/bot'
+
+    async def start(self):
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host=self.host, port=self.port).start()
+        logger.info('Fake Telegram is running on %s', self.url)
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def add_update(self, **update):
+        update['update_id'] = next(self._update_ids)
+        self.added[update['update_id']] = time.perf_counter()
+        self.updates.append(update)
+        self._new_updates.set()
+        return update
+
+    def channel_post(self, chat_id, text='post'):
+        return self.add_update(channel_post=self.message(chat_id, text, chat_type='channel'))
+
+    def private_message(self, user_id, text, reply_to=None):
+        message = self.message(user_id, text, from_id=user_id)
+        if reply_to is not None:
+            message['reply_to_message'] = self.message(user_id, '', message_id=reply_to)
+        return self.add_update(message=message)
+
+    def message(self, chat_id, text, *, chat_type='private', from_id=None, message_id=None):
+        message = {
+            'message_id': message_id or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': chat_type},
+            'text': text,
+        }
+        if from_id is not None:
+            message['from'] = {'id': from_id, 'is_bot': False, 'first_name': str(from_id)}
+        return message
+
+    async def deliver(self):
+        """Post all queued updates to the registered webhook."""
+        url, secret = self.webhook
+        async with aiohttp.ClientSession() as session:
+            while self.updates:
+                update = self.updates.pop(0)
+                headers = {'X-Telegram-Bot-Api-Secret-Token': secret}
+                async with session.post(url, json=update, headers=headers) as resp:
+                    if resp.status != 200:
+                        raise RuntimeError(f'{resp.status} {resp.reason}')
+
+    async def handle(self, request):
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = {}
+            for key, value in (await request.post()).items():
+                try:
+                    params[key] = json.loads(value)
+                except ValueError:
+                    params[key] = value
+        method = request.match_info['method']
+        if method in self.FLOODED_METHODS and random.random() < self.flood_rate:
+            self.flooded += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }, status=429)
+        self.calls.append((method, params, time.perf_counter()))
+        handler = getattr(self, f'api_{method}', None)
+        if handler is None:
+            return web.json_response({'ok': True, 'result': True})
+        return web.json_response({'ok': True, 'result': await handler(params)})
+
+    async def api_getMe(self, params):
+        return {'id': 0, 'is_bot': True, 'first_name': 'Tips', 'username': 'tips_bot'}
+
+    async def api_setWebhook(self, params):
+        self.webhook = (params['url'], params.get('secret_token', ''))
+        return True
+
+    async def api_deleteWebhook(self, params):
+        self.webhook = None
+        return True
+
+    async def api_getUpdates(self, params):
+        offset = params.get('offset') or 0
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        if not self.updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), min(params.get('timeout') or 0, 1))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:params.get('limit') or 100]
+
+    async def api_sendMessage(self, params):
+        return self.message(params['chat_id'], params.get('text', ''), chat_type='channel')
+
+    async def api_editMessageText(self, params):
+        return self.message(params['chat_id'], params.get('text', ''), message_id=params['message_id'])
+
+    async def api_getChatAdministrators(self, params):
+        return [{
+            'status': 'creator',
+            'is_anonymous': False,
+            'user': {'id': self.owner_id, 'is_bot': False, 'first_name': 'Owner'},
+        }]
+
+
+async def main(host, port, flood_rate):
+    fake = FakeTelegram(host, port, flood_rate=flood_rate)
+    await fake.start()
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('host', type=str, default='127.0.0.1', nargs='?')
+    parser.add_argument('port', type=int, default=8081, nargs='?')
+    parser.add_argument('--flood-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(args.host, args.port, args.flood_rate))
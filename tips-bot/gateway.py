@@ -1,65 +1,185 @@
+import asyncio
 import json
 import logging
-from decimal import Decimal
+from typing import Optional
 
 import aiohttp
 from aiohttp import FormData
 
 import entities as e
-import ton
+import prometheus
 
 ENTRYPOINT = ''
 TRACKING_ENTRYPOINT = ''
+CONNECTION_LIMIT = 100
+REQUEST_TIMEOUT = 30
+# confirmedTransfer in ton-interaction/track_server/server.ts sends up to SEND_ATTEMPTS times, checks the seqno
+# SEND_CHECKS times SEND_CHECK_DELAY seconds apart after each send, then once more after SEND_FINAL_DELAY. Only then
+# does it answer TRANSFER_REJECTED, so /send must not time out earlier, or a failed transfer is never refunded.
+SEND_ATTEMPTS = 3
+SEND_CHECKS = 3
+SEND_CHECK_DELAY = 20
+SEND_FINAL_DELAY = 60
+# Allowance for each chain RPC of the schedule (transfers and seqno checks), and for the rest
+SEND_RPC_LATENCY = 5
+SEND_MARGIN = 30
+SEND_TIMEOUT = (
+    SEND_ATTEMPTS * SEND_CHECKS * SEND_CHECK_DELAY + SEND_FINAL_DELAY
+    + (2 + SEND_ATTEMPTS * (1 + SEND_CHECKS)) * SEND_RPC_LATENCY + SEND_MARGIN
+)
+RETRIES = 3
+RETRY_DELAY = 0.5
+TRACKING_CONCURRENCY = 10
+TRANSIENT_STATUSES = {502, 503, 504}
+# The only answer of /send and /sendBatch that guarantees nothing was sent
+TRANSFER_REJECTED = 'Transfer unsuccessfull'
 
 logger = logging.getLogger(__name__)
+client: Optional['GatewayClient'] = None
 
 
-async def _request(session, url, method, *, query=None, form=None, data=None, bearer=None):
-    if form is not None:
-        form = FormData(form)
-    params = {
-        'params': query,
-        'json' if isinstance(data, dict) else 'data': data or form,
-    }
-    if bearer is not None:
-        params['headers']['Authorization'] = f'Bearer {bearer}'
-    async with session.request(method.upper(), url, **params) as resp:
-        if resp.status != 200:
-            raise RuntimeError(f'{resp.status} {resp.reason}')
-        return await resp.text()
+class GatewayError(RuntimeError):
+    def __init__(self, status, reason, text=''):
+        super().__init__(f'{status} {reason}')
+        self.status = status
+        self.text = text
+
+
+class GatewayClient:
+    """Keeps one keep-alive session to the gateway for the whole app."""
+
+    def __init__(self, entrypoint, *, limit=CONNECTION_LIMIT, timeout=REQUEST_TIMEOUT, retries=RETRIES,
+                 retry_delay=RETRY_DELAY):
+        self.entrypoint = entrypoint
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=limit),
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        )
+
+    async def close(self):
+        await self.session.close()
+
+    async def request(self, path, method, *, query=None, form=None, data=None, bearer=None, timeout=None,
+                      idempotent=True):
+        """Make a request, retrying transient failures with exponential backoff.
+
+        Non-idempotent requests are only retried when the connection could not be established at all.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._request(
+                    path, method, query=query, form=form, data=data, bearer=bearer, timeout=timeout
+                )
+            except aiohttp.ClientConnectorError:
+                if attempt == self.retries:
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if not idempotent or attempt == self.retries:
+                    raise
+            except GatewayError as err:
+                if not idempotent or err.status not in TRANSIENT_STATUSES or attempt == self.retries:
+                    raise
+            delay = self.retry_delay * 2 ** attempt
+            logger.warning('Gateway %s failed, retrying in %s seconds', path, delay)
+            await asyncio.sleep(delay)
+
+    async def _request(self, path, method, *, query=None, form=None, data=None, bearer=None, timeout=None):
+        if form is not None:
+            form = FormData(form)
+        params = {
+            'params': query,
+            'json' if isinstance(data, dict) else 'data': data or form,
+            'headers': {},
+        }
+        if bearer is not None:
+            params['headers']['Authorization'] = f'Bearer {bearer}'
+        if timeout is not None:
+            params['timeout'] = aiohttp.ClientTimeout(total=timeout)
+        with prometheus.gateway_seconds.time(path):
+            try:
+                async with self.session.request(method.upper(), f'{self.entrypoint}{path}', **params) as resp:
+                    if resp.status != 200:
+                        raise GatewayError(resp.status, resp.reason, await resp.text())
+                    return await resp.text()
+            except Exception:
+                prometheus.errors.inc('gateway')
+                raise
+
+
+async def run():
+    global client
+    await shutdown()
+    client = GatewayClient(ENTRYPOINT, limit=CONNECTION_LIMIT, timeout=REQUEST_TIMEOUT)
+
+
+async def shutdown():
+    global client
+    if client is None:
+        return
+    await client.close()
+    client = None
 
 
 async def start_tracking():
     wallets = await e.objects.execute(e.Wallet.select())
-    for wallet in wallets:
-        await track_wallet(wallet)
+    semaphore = asyncio.Semaphore(TRACKING_CONCURRENCY)
+
+    async def track(wallet):
+        async with semaphore:
+            await track_wallet(wallet)
+
+    await asyncio.gather(*map(track, wallets))
 
 
 async def track_wallet(wallet):
-    async with aiohttp.ClientSession() as session:
-        url = f'{ENTRYPOINT}/startPaymentTracking'
-        data = {
-            'address': wallet.address,
-            'callbackUrl': TRACKING_ENTRYPOINT,
-            'trackingState': json.loads(wallet.state or '""') or 'current',
-        }
-        result = await _request(session, url, 'post', data=data)
-        logging.info('Tracking wallet %s: %s', wallet.address, result)
-        return result
+    data = {
+        'address': wallet.address,
+        'callbackUrl': TRACKING_ENTRYPOINT,
+        'trackingState': json.loads(wallet.state or '""') or 'current',
+    }
+    result = await client.request('/startPaymentTracking', 'post', data=data)
+    logging.info('Tracking wallet %s: %s', wallet.address, result)
+    return result
+
+
+def not_sent(err):
+    """Whether a failed /send or /sendBatch certainly didn't send anything.
+
+    Errors raised after the transfer was broadcast come back as 500 as well, and a proxy answers 502/504 whatever
+    happened behind it, so only the explicit rejection and an unreachable gateway count.
+    """
+    if isinstance(err, aiohttp.ClientConnectorError):
+        return True
+    return isinstance(err, GatewayError) and err.status == 400 and err.text.strip() == TRANSFER_REJECTED
 
 
 async def send(*, from_address, private_key, to_address, amount, text=None):
-    if isinstance(amount, Decimal):
-        amount = ton.ton_to_int(amount)
-    async with aiohttp.ClientSession() as session:
-        url = f'{ENTRYPOINT}/send'
-        data = {
-            'sourceAddress': from_address,
-            'sourceKey': private_key,
-            'destinationAddress': to_address,
-            'amount': amount,
-            'senderPaysFees': False,
-        }
-        if text is not None:
-            data['message'] = text
-        return json.loads(await _request(session, url, 'post', data=data))
+    data = {
+        'sourceAddress': from_address,
+        'sourceKey': private_key,
+        'destinationAddress': to_address,
+        'amount': amount,
+        'senderPaysFees': False,
+    }
+    if text is not None:
+        data['message'] = text
+    return json.loads(await client.request('/send', 'post', data=data, timeout=SEND_TIMEOUT, idempotent=False))
+
+
+async def send_batch(*, from_address, private_key, transfers):
+    """Send several transfers in one message, transfers are dicts with to_address, amount and optional text."""
+    messages = []
+    for transfer in transfers:
+        message = {'destinationAddress': transfer['to_address'], 'amount': transfer['amount']}
+        if transfer.get('text') is not None:
+            message['message'] = transfer['text']
+        messages.append(message)
+    data = {
+        'sourceAddress': from_address,
+        'sourceKey': private_key,
+        'messages': messages,
+        'senderPaysFees': False,
+    }
+    return json.loads(await client.request('/sendBatch', 'post', data=data, timeout=SEND_TIMEOUT, idempotent=False))
@@ -0,0 +1,120 @@
+"""Transaction history exports, streamed in chunks paged by rowid.
+
+Exports, and chat stats, are reached through links signed with SECRET, which the bot hands out to the user.
+"""
+import csv
+import hashlib
+import hmac
+import io
+import json
+import time
+from datetime import datetime, timezone
+
+import entities as e
+import money
+
+SECRET = ''
+URL = ''
+LINK_TTL = 24 * 3600
+CHUNK_SIZE = 1000
+USER = 'user'
+CHAT = 'chat'
+FORMATS = {'jsonl': 'application/x-ndjson', 'csv': 'text/csv'}
+FIELDS = ('rowid', 'date', 'type', 'amount', 'amount_ton', 'chat_id', 'invoice_id', 'seqno', 'hash')
+
+
+def enabled():
+    return bool(SECRET and URL)
+
+
+def signature(scope, key, expires):
+    return hmac.new(SECRET.encode(), f'{scope}:{key}:{expires}'.encode(), hashlib.sha256).hexdigest()
+
+
+def signed_query(scope, key):
+    expires = int(time.time()) + LINK_TTL
+    return f'expires={expires}&signature={signature(scope, key, expires)}'
+
+
+def link(scope, key, fmt='csv'):
+    return f'{URL}/history/{scope}/{key}?format={fmt}&{signed_query(scope, key)}'
+
+
+def links(scope, key):
+    return {fmt: link(scope, key, fmt) for fmt in FORMATS}
+
+
+def verify(scope, key, expires, signed):
+    """Raises PermissionError unless the link is signed by us and not expired."""
+    if not SECRET or int(expires) < time.time() or not hmac.compare_digest(signature(scope, key, expires), signed):
+        raise PermissionError('Wrong or expired link')
+
+
+def parse_date(value):
+    """ISO date or datetime, UTC unless it has a timezone, raises ValueError."""
+    if value is None:
+        return None
+    date = datetime.fromisoformat(value)
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+
+def chunk_query(scope, key, after, since, until, size):
+    """Both scopes page over an index starting with their key, so no chunk sorts."""
+    query = e.Transaction.select(
+        e.Transaction.rowid, e.Transaction.date, e.Transaction.amount, e.Transaction.seqno, e.Transaction.hash,
+        e.Transaction.invoice, e.Transaction.chat_id,
+    ).where(
+        (e.Transaction.user_id == key) if scope == USER else (e.Transaction.chat_id == key),
+        e.Transaction.rowid > after,
+    )
+    if since is not None:
+        query = query.where(e.Transaction.date >= since)
+    if until is not None:
+        query = query.where(e.Transaction.date < until)
+    return query.order_by(e.Transaction.rowid).limit(size).dicts()
+
+
+async def chunks(scope, key, *, after=0, since=None, until=None, limit=None):
+    """Yield lists of export rows, each chunk is a separate short query starting after the last rowid seen."""
+    while limit is None or limit > 0:
+        size = CHUNK_SIZE if limit is None else min(CHUNK_SIZE, limit)
+        rows = list(await e.objects.execute(chunk_query(scope, key, after, since, until, size)))
+        if not rows:
+            return
+        yield [export_row(row) for row in rows]
+        if len(rows) < size:
+            return
+        after = rows[-1]['rowid']
+        if limit is not None:
+            limit -= len(rows)
+
+
+def export_row(row):
+    return {
+        'rowid': row['rowid'],
+        'date': row['date'].astimezone(timezone.utc).isoformat(),
+        'type': 'tip' if row['invoice'] else 'withdrawal',
+        'amount': row['amount'],
+        'amount_ton': money.display(row['amount'], decimals=money.DECIMALS),
+        'chat_id': row['chat_id'],
+        'invoice_id': row['invoice'],
+        'seqno': row['seqno'],
+        'hash': row['hash'],
+    }
+
+
+def header(fmt):
+    return render_csv([dict(zip(FIELDS, FIELDS))]) if fmt == 'csv' else ''
+
+
+def render(rows, fmt):
+    if fmt == 'csv':
+        return render_csv(rows)
+    return ''.join(json.dumps(row) + '\n' for row in rows)
+
+
+def render_csv(rows):
+    output = io.StringIO()
+    writer = csv.DictWriter(output, FIELDS, lineterminator='\n')
+    writer.writerows(rows)
+    return output.getvalue()
@@ -1,14 +1,23 @@
-TIPS_TEXT_BOTTOM = 'Total tips: *{amount:0.3f} TON*'
+TIPS_TEXT_BOTTOM = 'Total tips: *{amount} TON*'
 START_MESSAGE = 'Hello, I am a tip bot. You can add me to your channel and I will add a tip button to every message.'
-BALANCE_MESSAGE = 'Your balance: *{amount:0.3f} TON*'
+BALANCE_MESSAGE = 'Your balance: *{amount} TON*'
 WITHDRAW_BUTTON = 'Withdraw'
 WITHDRAW_MESSAGE = 'To confirm, enter the wallet address and the amount to withdraw separated by a space'
 WITHDRAW_PLACEHOLDER = 'ADDRESS AMOUNT'
 WITHDRAW_EXECUTED = 'Withdraw is executed'
+WITHDRAW_FAILED = 'Withdraw failed, the funds are returned to your balance'
+WITHDRAW_UNCONFIRMED = 'Withdraw is not confirmed yet, please contact support'
 NOT_ENOUGH_FUNDS = 'Not enough funds'
 INCORRECT_AMOUNT = 'Incorrect amount'
+INCORRECT_ADDRESS = 'Incorrect wallet address'
 WRONG_MESSAGE = 'Wrong message'
 UNKNOWN_BUTTON = 'Unknown button'
 SENDING = 'Sending, please wait...'
 CUSTOM_TIP = '... TON'
 HELP_BUTTON = '?'
+HISTORY_USER = 'Your transactions: {csv} (CSV), {jsonl} (JSON lines)'
+HISTORY_CHAT = 'Tips in chat {chat_id}: {csv} (CSV), {jsonl} (JSON lines)'
+HISTORY_UNAVAILABLE = 'History export is not available'
+STATS_CHAT = 'Chat {chat_id}: {amount} TON from {tips} tips, {today} TON today'
+STATS_TOP = 'Post {message_id}: {amount} TON'
+STATS_NONE = 'No tips yet'
@@ -3,43 +3,128 @@ import argparse
 import asyncio
 import json
 import logging
+import os
 import signal
 import sys
-from decimal import Decimal
 
 import async_timeout
 
+import async_sqlite
+import balances
 import bot
 import entities as e
 import gateway
+import history
+import migrations
+import money
+import payouts
+import prometheus
+import reconcile
 import server
+import sharding
 import ton
+import tracking
 
 CONFIG = 'config.json'
+RESTART_DELAY = 5
+# Parsed with money.parse, so they are kept as the exact decimal text of the file
+MONEY_KEYS = ('tips', 'fee', 'min_withdraw')
 
 toolbox = None
 logger = logging.getLogger(__name__)
+children = []
+stopping = False
 
 
-async def run(cfg_file):
+def load_config(cfg_file):
+    with open(cfg_file) as file:
+        text = file.read()
+    config = json.loads(text)
+    exact = json.loads(text, parse_float=str)
+    for key in MONEY_KEYS:
+        if key in exact:
+            config[key] = exact[key]
+    return config
+
+
+def init_database(config):
+    backend = config.get('database_backend', e.SQLITE)
+    if config.get('processes', 1) > 1 and backend != e.POSTGRES:
+        raise ValueError('Several processes need the postgres database backend')
+    if backend == e.POSTGRES:
+        return e.init_database(config['database'], backend, **config.get('postgres', {}))
+    return e.init_database(
+        config['database'],
+        readers=config.get('database_readers', async_sqlite.DEFAULT_READERS),
+        pragmas=config.get('database_pragmas', {}),
+    )
+
+
+async def run(cfg_file, process=0):
     try:
-        with open(cfg_file) as file:
-            config = json.load(file, parse_float=Decimal)
-        e.database.init(config['database'])
-        if not e.database.get_tables():
-            e.database.create_tables([e.Invoice, e.Wallet, e.Transaction, e.User])
+        config = load_config(cfg_file)
+        sharding.COUNT = config.get('processes', sharding.COUNT)
+        sharding.INDEX = process
+        sharding.POLL_INTERVAL = float(config.get('poll_interval', sharding.POLL_INTERVAL))
+        database = init_database(config)
+        if not sharding.sharded():
+            logger.info('Database schema version %d', migrations.migrate(database))
         gateway.ENTRYPOINT = config['ton_gateway']
         gateway.TRACKING_ENTRYPOINT = f'http://{config["host"]}:{config["port"]}/tracking'
+        gateway.CONNECTION_LIMIT = config.get('gateway_connections', gateway.CONNECTION_LIMIT)
+        gateway.REQUEST_TIMEOUT = float(config.get('gateway_timeout', gateway.REQUEST_TIMEOUT))
+        gateway.TRACKING_CONCURRENCY = config.get('tracking_concurrency', gateway.TRACKING_CONCURRENCY)
+        payouts.BATCH_SIZE = config.get('payout_batch_size', payouts.BATCH_SIZE)
+        payouts.BATCH_WINDOW = float(config.get('payout_batch_window', payouts.BATCH_WINDOW))
+        payouts.REFRESH_INTERVAL = float(config.get('wallet_refresh_interval', payouts.REFRESH_INTERVAL))
+        balances.CACHE_SIZE = config.get('balance_cache_size', balances.CACHE_SIZE)
+        ton.recent_payments.maxsize = config.get('recent_payments', ton.RECENT_PAYMENTS)
+        tracking.MAX_PENDING = config.get('tracking_max_pending', tracking.MAX_PENDING)
+        tracking.CONSUMERS = config.get('tracking_consumers', tracking.CONSUMERS)
+        tracking.MAX_ATTEMPTS = config.get('tracking_max_attempts', tracking.MAX_ATTEMPTS)
+        balances.VERIFY_INTERVAL = float(config.get('balance_verify_interval', balances.VERIFY_INTERVAL))
+        reconcile.INTERVAL = float(config.get('reconcile_interval', reconcile.INTERVAL))
+        reconcile.REPAIR = config.get('reconcile_repair', reconcile.REPAIR)
+        if sharding.sharded():
+            # Other processes change balances too, so a cached balance can't be trusted
+            balances.CACHE_SIZE = 0
         bot.TIPS = list(sorted([
-            (key, ton.ton_to_int(value)) for key, value in config['tips'].items()
+            (key, money.to_nano(value)) for key, value in config['tips'].items()
         ], key=lambda x: x[1]))
+        prometheus.ENABLED = config.get('metrics', prometheus.ENABLED)
         bot.HELP_URL = config.get('help_url', bot.HELP_URL)
         bot.CUSTOM_TIP = config.get('custom_tip', bot.CUSTOM_TIP)
-        ton.MIN_WITHDRAW = config.get('min_withdraw', ton.MIN_WITHDRAW)
-        ton.FEE = config.get('fee', ton.FEE)
+        bot.WORKERS = config.get('workers', bot.WORKERS)
+        bot.MAX_PENDING_UPDATES = config.get('max_pending_updates', bot.MAX_PENDING_UPDATES)
+        bot.INBOX_LIMIT = config.get('inbox_limit', bot.INBOX_LIMIT)
+        bot.HANDLER_TIMEOUT = config.get('handler_timeout', bot.HANDLER_TIMEOUT)
+        bot.API_URL = config.get('bot_api_url', bot.API_URL)
+        bot.CHAT_OWNER_TTL = config.get('chat_owner_ttl', bot.CHAT_OWNER_TTL)
+        bot.EDIT_WINDOW = float(config.get('edit_window', bot.EDIT_WINDOW))
+        # The global Bot API limit is shared between processes, per chat limits aren't since chats are split
+        bot.RATE_LIMIT = float(config.get('rate_limit', bot.RATE_LIMIT)) / sharding.COUNT
+        bot.CHAT_RATE_LIMIT = float(config.get('chat_rate_limit', bot.CHAT_RATE_LIMIT))
+        bot.GROUP_RATE_LIMIT = float(config.get('group_rate_limit', bot.GROUP_RATE_LIMIT))
+        history_config = config.get('history', {})
+        history.URL = history_config.get('url', history.URL).rstrip('/')
+        history.SECRET = history_config.get('secret', history.SECRET)
+        history.LINK_TTL = history_config.get('link_ttl', history.LINK_TTL)
+        webhook = config.get('webhook', {})
+        bot.WEBHOOK_URL = webhook.get('url', bot.WEBHOOK_URL).rstrip('/')
+        bot.WEBHOOK_SECRET = webhook.get('secret', bot.WEBHOOK_SECRET)
+        if 'min_withdraw' in config:
+            ton.MIN_WITHDRAW = money.to_nano(config['min_withdraw'])
+        if 'fee' in config:
+            ton.FEE_BPS = money.percent_to_bps(config['fee'])
+        await gateway.run()
+        await balances.run()
+        await payouts.run()
         await bot.run(config['bot_token'])
-        await server.run(config['host'], config['port'])
-        await gateway.start_tracking()
+        await tracking.run()
+        await reconcile.run()
+        await server.run(config['host'], config['port'], reuse_port=sharding.sharded())
+        if sharding.leader():
+            await gateway.start_tracking()
     except Exception:
         await stop()
         raise
@@ -48,7 +133,12 @@ async def run(cfg_file):
 async def stop():
     try:
         await server.shutdown()
+        await reconcile.shutdown()
+        await tracking.shutdown()
+        await payouts.shutdown()
+        await balances.shutdown()
         await bot.shutdown()
+        await gateway.shutdown()
         await e.objects.close()
         logger.info('Goodbye')
         tasks = [t for t in asyncio.all_tasks() if not t.done() and t != asyncio.current_task()]
@@ -61,10 +151,46 @@ async def stop():
         asyncio.get_event_loop().stop()
 
 
+async def supervise(cfg_file, log_file):
+    """Migrate the database, then keep one bot process running per shard."""
+    try:
+        config = load_config(cfg_file)
+        logger.info('Database schema version %d', migrations.migrate(init_database(config)))
+        command = [sys.executable, os.path.abspath(__file__), cfg_file] + ([log_file] if log_file else [])
+        await asyncio.gather(*(
+            keep_running(command + ['--process', str(index)]) for index in range(config['processes'])
+        ))
+    except Exception as err:
+        logger.exception('Supervisor exception: %r', err)
+        await stop_supervisor()
+
+
+async def keep_running(command):
+    while not stopping:
+        child = await asyncio.create_subprocess_exec(*command)
+        children.append(child)
+        code = await child.wait()
+        children.remove(child)
+        if not stopping:
+            logger.error('%s exited with %s, restarting in %d s', command, code, RESTART_DELAY)
+            await asyncio.sleep(RESTART_DELAY)
+
+
+async def stop_supervisor():
+    global stopping
+    stopping = True
+    for child in children:
+        child.terminate()
+    await asyncio.gather(*(child.wait() for child in children))
+    logger.info('Goodbye')
+    asyncio.get_event_loop().stop()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('config', type=str, default=CONFIG, nargs='?')
     parser.add_argument('log_file', type=str, nargs='?')
+    parser.add_argument('--process', type=int, help='index of this process, set by the supervisor')
     args = parser.parse_args()
     logger_options = {
         'level': logging.INFO,
@@ -79,8 +205,15 @@ if __name__ == '__main__':
         sys.stderr = sys.stdout = open(args.log_file, 'a')
     logging.basicConfig(**logger_options)
     loop = asyncio.get_event_loop()
-    asyncio.ensure_future(run(args.config))
-    for signame in ('SIGINT', 'SIGTERM'):
-        loop.add_signal_handler(getattr(signal, signame), lambda: asyncio.ensure_future(stop()))
+    if args.process is None and load_config(args.config).get('processes', 1) > 1:
+        asyncio.ensure_future(supervise(args.config, args.log_file))
+        for signame in ('SIGINT', 'SIGTERM'):
+            loop.add_signal_handler(getattr(signal, signame), lambda: asyncio.ensure_future(stop_supervisor()))
+    else:
+        asyncio.ensure_future(run(args.config, args.process or 0))
+        for signame in ('SIGINT', 'SIGTERM'):
+            loop.add_signal_handler(getattr(signal, signame), lambda: asyncio.ensure_future(stop()))
+        # Wallets are edited in the database directly, SIGHUP picks up the change
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(bot.load_keyboard()))
     loop.run_forever()
     loop.close()
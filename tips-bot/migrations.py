@@ -0,0 +1,202 @@
+import logging
+
+from peewee import PostgresqlDatabase
+
+import stats
+
+logger = logging.getLogger(__name__)
+
+# Persistent sqlite pragmas, stored in the database file itself
+PERSISTENT_PRAGMAS = (
+    ('journal_mode', 'wal'),
+)
+
+
+def run_ddl(database, *statements):
+    """Run frozen DDL written with Postgres types, sqlite gets INTEGER for them as peewee would create.
+
+    Migrations never create tables from the models, which keep changing, a version must mean the same schema forever.
+    """
+    for sql in statements:
+        if not isinstance(database, PostgresqlDatabase):
+            sql = sql.replace('BIGINT', 'INTEGER').replace('SERIAL', 'INTEGER')
+        database.execute_sql(sql)
+
+
+def initial_schema(database):
+    run_ddl(
+        database,
+        'CREATE TABLE IF NOT EXISTS "invoice" ("id" TEXT NOT NULL PRIMARY KEY, "chat_id" BIGINT NOT NULL, '
+        '"message_id" INTEGER NOT NULL, "funded" BIGINT NOT NULL, "message" TEXT NOT NULL, "entities" TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS "invoice_chat_id_message_id" ON "invoice" ("chat_id", "message_id")',
+        'CREATE TABLE IF NOT EXISTS "wallet" ("id" SERIAL NOT NULL PRIMARY KEY, "address" TEXT NOT NULL, '
+        '"private_key" TEXT, "state" TEXT)',
+        'CREATE INDEX IF NOT EXISTS "wallet_address" ON "wallet" ("address")',
+        'CREATE TABLE IF NOT EXISTS "transaction" ("rowid" SERIAL NOT NULL PRIMARY KEY, "user_id" BIGINT NOT NULL, '
+        '"date" INTEGER NOT NULL, "amount" BIGINT NOT NULL, "wallet_id" INTEGER NOT NULL, "invoice_id" TEXT, '
+        '"seqno" TEXT, FOREIGN KEY ("wallet_id") REFERENCES "wallet" ("id"), '
+        'FOREIGN KEY ("invoice_id") REFERENCES "invoice" ("id"))',
+        'CREATE INDEX IF NOT EXISTS "transaction_user_id" ON "transaction" ("user_id")',
+        'CREATE INDEX IF NOT EXISTS "transaction_wallet_id" ON "transaction" ("wallet_id")',
+        'CREATE INDEX IF NOT EXISTS "transaction_invoice_id" ON "transaction" ("invoice_id")',
+        'CREATE TABLE IF NOT EXISTS "user" ("id" BIGINT NOT NULL PRIMARY KEY, "balance" BIGINT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS "chat" ("id" BIGINT NOT NULL PRIMARY KEY, "owner_id" BIGINT NOT NULL, '
+        '"updated" INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS "withdrawal" ("id" SERIAL NOT NULL PRIMARY KEY, "transaction_id" INTEGER NOT NULL, '
+        '"address" TEXT NOT NULL, "state" TEXT NOT NULL, "chat_id" BIGINT, "message_id" INTEGER, '
+        '"updated" INTEGER NOT NULL, "error" TEXT, FOREIGN KEY ("transaction_id") REFERENCES "transaction" ("rowid"))',
+        'CREATE INDEX IF NOT EXISTS "withdrawal_transaction_id" ON "withdrawal" ("transaction_id")',
+        'CREATE INDEX IF NOT EXISTS "withdrawal_state" ON "withdrawal" ("state")',
+    )
+
+
+def hot_path_indexes(database):
+    database.execute_sql('CREATE INDEX IF NOT EXISTS "transaction_user_id" ON "transaction" ("user_id")')
+    database.execute_sql('CREATE INDEX IF NOT EXISTS "transaction_invoice_id" ON "transaction" ("invoice_id")')
+    database.execute_sql('CREATE INDEX IF NOT EXISTS "transaction_wallet_id" ON "transaction" ("wallet_id")')
+    database.execute_sql(
+        'CREATE INDEX IF NOT EXISTS "invoice_chat_id_message_id" ON "invoice" ("chat_id", "message_id")'
+    )
+    database.execute_sql('ANALYZE')
+
+
+def tracking_batches(database):
+    run_ddl(
+        database,
+        'CREATE TABLE IF NOT EXISTS "tracking_batch" ("id" SERIAL NOT NULL PRIMARY KEY, "address" TEXT NOT NULL, '
+        '"payments" TEXT NOT NULL, "received" INTEGER NOT NULL)',
+    )
+
+
+def payment_identity(database):
+    columns = {column.name for column in database.get_columns('transaction')}
+    for column in ('lt', 'hash'):
+        if column not in columns:
+            # Databases created by earlier releases, whose initial_schema followed the models, have them already
+            database.execute_sql(f'ALTER TABLE "transaction" ADD COLUMN "{column}" TEXT')
+    database.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS "transaction_hash" ON "transaction" ("hash")')
+
+
+def update_inbox(database):
+    run_ddl(
+        database,
+        'CREATE TABLE IF NOT EXISTS "inbox_update" ("update_id" BIGINT NOT NULL PRIMARY KEY, "data" TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS "setting" ("key" TEXT NOT NULL PRIMARY KEY, "value" TEXT NOT NULL)',
+    )
+
+
+def shard_columns(database):
+    for table in ('inbox_update', 'tracking_batch'):
+        if 'chat_id' not in {column.name for column in database.get_columns(table)}:
+            run_ddl(database, f'ALTER TABLE "{table}" ADD COLUMN "chat_id" BIGINT')
+
+
+def history_indexes(database):
+    for column in ('user_id', 'invoice_id'):
+        database.execute_sql(
+            f'CREATE INDEX IF NOT EXISTS "transaction_{column}_rowid_date" '
+            f'ON "transaction" ("{column}", "rowid", "date")'
+        )
+    # Prefixes of the new ones
+    database.execute_sql('DROP INDEX IF EXISTS "transaction_user_id"')
+    database.execute_sql('DROP INDEX IF EXISTS "transaction_invoice_id"')
+
+
+def chat_stats(database):
+    run_ddl(
+        database,
+        'CREATE TABLE IF NOT EXISTS "chat_stats" ("chat_id" BIGINT NOT NULL PRIMARY KEY, "owner_id" BIGINT NOT NULL, '
+        '"tips" INTEGER NOT NULL, "amount" BIGINT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS "chatstats_owner_id" ON "chat_stats" ("owner_id")',
+        'CREATE TABLE IF NOT EXISTS "chat_day" ("chat_id" BIGINT NOT NULL, "day" INTEGER NOT NULL, '
+        '"tips" INTEGER NOT NULL, "amount" BIGINT NOT NULL, PRIMARY KEY ("chat_id", "day"))',
+        'CREATE INDEX IF NOT EXISTS "invoice_chat_id_funded" ON "invoice" ("chat_id", "funded")',
+    )
+    stats.rebuild(database)
+
+
+def parked_payments(database):
+    run_ddl(
+        database,
+        'CREATE TABLE IF NOT EXISTS "parked_payment" ("id" SERIAL NOT NULL PRIMARY KEY, "address" TEXT NOT NULL, '
+        '"payment" TEXT NOT NULL, "chat_id" BIGINT, "hash" TEXT, "error" TEXT NOT NULL, "parked" INTEGER NOT NULL)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "parkedpayment_hash" ON "parked_payment" ("hash")',
+    )
+
+
+def inbox_done(database):
+    if 'done' not in {column.name for column in database.get_columns('inbox_update')}:
+        run_ddl(database, 'ALTER TABLE "inbox_update" ADD COLUMN "done" INTEGER')
+    run_ddl(database, 'CREATE INDEX IF NOT EXISTS "inboxupdate_done" ON "inbox_update" ("done")')
+
+
+def withdrawal_requests(database):
+    columns = {column.name for column in database.get_columns('withdrawal')}
+    for column in ('request_chat_id', 'request_message_id'):
+        if column not in columns:
+            run_ddl(database, f'ALTER TABLE "withdrawal" ADD COLUMN "{column}" BIGINT')
+    run_ddl(
+        database,
+        'CREATE UNIQUE INDEX IF NOT EXISTS "withdrawal_request_chat_id_request_message_id" '
+        'ON "withdrawal" ("request_chat_id", "request_message_id")',
+    )
+
+
+def transaction_chats(database):
+    if 'chat_id' not in {column.name for column in database.get_columns('transaction')}:
+        run_ddl(database, 'ALTER TABLE "transaction" ADD COLUMN "chat_id" BIGINT')
+    database.execute_sql(
+        'UPDATE "transaction" SET "chat_id" = (SELECT "chat_id" FROM "invoice" WHERE "invoice"."id" = '
+        '"transaction"."invoice_id") WHERE "invoice_id" IS NOT NULL AND "chat_id" IS NULL'
+    )
+    run_ddl(
+        database,
+        'CREATE INDEX IF NOT EXISTS "transaction_chat_id_rowid_date" ON "transaction" ("chat_id", "rowid", "date")',
+    )
+
+
+# Append only, a migration's position in the list is its schema version
+MIGRATIONS = [
+    initial_schema,
+    hot_path_indexes,
+    tracking_batches,
+    payment_identity,
+    update_inbox,
+    shard_columns,
+    history_indexes,
+    chat_stats,
+    parked_payments,
+    inbox_done,
+    withdrawal_requests,
+    transaction_chats,
+]
+
+
+def get_version(database):
+    if isinstance(database, PostgresqlDatabase):
+        database.execute_sql('CREATE TABLE IF NOT EXISTS "schema_version" ("version" INTEGER NOT NULL)')
+        return database.execute_sql('SELECT MAX("version") FROM "schema_version"').fetchone()[0] or 0
+    return database.execute_sql('PRAGMA user_version').fetchone()[0]
+
+
+def set_version(database, version):
+    if isinstance(database, PostgresqlDatabase):
+        database.execute_sql('INSERT INTO "schema_version" ("version") VALUES (%s)', (version,))
+    else:
+        database.execute_sql(f'PRAGMA user_version = {version}')
+
+
+def migrate(database):
+    """Bring the schema up to date, each migration runs in its own transaction together with the version bump."""
+    if not isinstance(database, PostgresqlDatabase):
+        for pragma, value in PERSISTENT_PRAGMAS:
+            database.execute_sql(f'PRAGMA {pragma} = {value}')
+    version = get_version(database)
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info('Applying migration %d: %s', number, migration.__name__)
+        with database.atomic():
+            migration(database)
+            set_version(database, number)
+    version = get_version(database)
+    database.close()
+    return version
@@ -0,0 +1,58 @@
+"""Integer money math. Amounts are nanotons (int), fees are basis points (int).
+
+Rounding rules:
+- parsing rejects more precision than the unit has instead of rounding;
+- fee splits round the recipient's share down, so the fee absorbs the remainder and share + fee == amount;
+- display truncates, so a shown balance is never more than what can be withdrawn.
+"""
+import re
+
+DECIMALS = 9
+NANO = 10 ** DECIMALS
+BPS = 10000
+
+re_number = re.compile(r'^(\d+)(?:\.(\d*))?$')
+
+
+def parse(value, decimals=DECIMALS):
+    """Convert a decimal number (str, int or the str of a float) to integer units of 10 ** -decimals.
+
+    Raises ValueError if the value is negative, malformed or more precise than decimals.
+    """
+    match = re_number.match(str(value).strip())
+    if not match:
+        raise ValueError(f'Incorrect amount: {value!r}')
+    whole, fraction = match.group(1), (match.group(2) or '').rstrip('0')
+    if len(fraction) > decimals:
+        raise ValueError(f'Too many decimals: {value!r}')
+    return int(whole) * 10 ** decimals + int(fraction.ljust(decimals, '0') or 0)
+
+
+def to_nano(value):
+    return parse(value)
+
+
+def percent_to_bps(value):
+    return parse(value, decimals=2)
+
+
+def display(nanotons, decimals=3):
+    """Nanotons as a TON amount with exactly `decimals` digits, truncated."""
+    sign = '-' if nanotons < 0 else ''
+    whole, fraction = divmod(abs(nanotons), NANO)
+    if not decimals:
+        return f'{sign}{whole}'
+    return f'{sign}{whole}.{fraction // 10 ** (DECIMALS - decimals):0{decimals}d}'
+
+
+def split(amount, fee_bps):
+    """(share, fee) of an amount, share + fee == amount."""
+    share = amount * (BPS - fee_bps) // BPS
+    return share, amount - share
+
+
+def split_many(amounts, fee_bps):
+    """Shares of many amounts and their total fee, each amount is split on its own as in split."""
+    keep = BPS - fee_bps
+    shares = [amount * keep // BPS for amount in amounts]
+    return shares, sum(amounts) - sum(shares)
@@ -0,0 +1,199 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+import prometheus
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+PRIORITY_NAMES = {HIGH: 'high', NORMAL: 'normal', LOW: 'low'}
+
+# Long polling and webhook management must never wait behind outgoing messages
+UNTHROTTLED = {'getUpdates', 'getMe', 'setWebhook', 'deleteWebhook'}
+
+current_priority = contextvars.ContextVar('outbound_priority', default=NORMAL)
+
+
+@contextlib.contextmanager
+def priority(level):
+    token = current_priority.set(level)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available."""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class Scheduler:
+    """Grants Bot API calls in priority order within the global and per-chat rate limits."""
+
+    def __init__(self, *, rate=30, chat_rate=1, group_rate=20 / 60, burst=3, max_retries=5):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate, rate)
+        self._chats = LRUCache(maxsize=100000)
+        self._heap = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.granted = {level: 0 for level in PRIORITY_NAMES}
+        self.wait_total = {level: 0.0 for level in PRIORITY_NAMES}
+        self.wait_max = {level: 0.0 for level in PRIORITY_NAMES}
+        self.retries = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._pump())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for *_, future in self._heap:
+            future.cancel()
+        self._heap = []
+
+    def chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if isinstance(chat_id, str) or chat_id < 0 else self.chat_rate
+            bucket = TokenBucket(rate, self.burst)
+            self._chats.set(chat_id, bucket)
+        return bucket
+
+    async def acquire(self, chat_id=None, level=None):
+        level = current_priority.get() if level is None else level
+        future = asyncio.get_running_loop().create_future()
+        started = time.monotonic()
+        heapq.heappush(self._heap, (level, next(self._seq), started, chat_id, future))
+        self._wakeup.set()
+        await future
+        waited = time.monotonic() - started
+        self.granted[level] += 1
+        self.wait_total[level] += waited
+        self.wait_max[level] = max(self.wait_max[level], waited)
+
+    def _grant(self, now):
+        """Grant the most urgent waiter that may go now, otherwise return how long to sleep."""
+        delay = self.bucket.delay(now)
+        if delay > 0:
+            return delay
+        delay = None
+        for item in sorted(self._heap):
+            level, seq, started, chat_id, future = item
+            if future.cancelled():
+                self._heap.remove(item)
+                heapq.heapify(self._heap)
+                return 0
+            chat_delay = self.chat_bucket(chat_id).delay(now) if chat_id is not None else 0
+            if chat_delay <= 0:
+                self.bucket.take()
+                if chat_id is not None:
+                    self.chat_bucket(chat_id).take()
+                self._heap.remove(item)
+                heapq.heapify(self._heap)
+                future.set_result(None)
+                return 0
+            delay = chat_delay if delay is None else min(delay, chat_delay)
+        return delay
+
+    async def _pump(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._grant(time.monotonic())
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    def retry_after(self, chat_id, seconds):
+        self.retries += 1
+        if chat_id is not None:
+            self.chat_bucket(chat_id).pause(seconds)
+        else:
+            self.bucket.pause(seconds)
+        self._wakeup.set()
+
+    def metrics(self):
+        queued = {name: 0 for name in PRIORITY_NAMES.values()}
+        for level, *_ in self._heap:
+            queued[PRIORITY_NAMES[level]] += 1
+        return {
+            'queued': queued,
+            'granted': {PRIORITY_NAMES[level]: count for level, count in self.granted.items()},
+            'wait_total': {PRIORITY_NAMES[level]: value for level, value in self.wait_total.items()},
+            'wait_max': {PRIORITY_NAMES[level]: value for level, value in self.wait_max.items()},
+            'retries': self.retries,
+        }
+
+
+class ScheduledBot(Bot):
+    """Bot whose API calls all pass through a Scheduler."""
+
+    def __init__(self, *args, scheduler, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._scheduler = scheduler
+
+    async def _post_timed(self, endpoint, data, **kwargs):
+        with prometheus.bot_api_seconds.time(endpoint):
+            try:
+                return await super()._do_post(endpoint, data, **kwargs)
+            except Exception:
+                prometheus.errors.inc('bot_api')
+                raise
+
+    async def _do_post(self, endpoint, data, **kwargs):
+        if endpoint in UNTHROTTLED:
+            return await self._post_timed(endpoint, data, **kwargs)
+        chat_id = data.get('chat_id') if endpoint.startswith(('send', 'edit')) else None
+        for attempt in range(self._scheduler.max_retries):
+            await self._scheduler.acquire(chat_id)
+            try:
+                return await self._post_timed(endpoint, data, **kwargs)
+            except RetryAfter as err:
+                if attempt + 1 == self._scheduler.max_retries:
+                    raise
+                logger.warning('%s to %s: retry after %s seconds', endpoint, chat_id, err.retry_after)
+                self._scheduler.retry_after(chat_id, err.retry_after)
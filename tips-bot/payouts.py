@@ -0,0 +1,241 @@
+import asyncio
+import logging
+from collections import Counter
+from typing import Optional
+
+import balances
+import bot
+import entities as e
+import gateway
+import prometheus
+import sharding
+import ton
+from wallets import WalletAllocator
+
+BATCH_SIZE = 4
+BATCH_WINDOW = 0.0
+# With several processes, tips stored by the others only reach the wallet balances when they are reloaded
+REFRESH_INTERVAL = 60.0
+
+logger = logging.getLogger(__name__)
+queue: Optional[asyncio.Queue] = None
+worker_tasks = []
+poll_task: Optional[asyncio.Task] = None
+refresh_task: Optional[asyncio.Task] = None
+# Withdrawal ids queued or being executed, when other processes create withdrawals too
+queued = set()
+allocator = WalletAllocator()
+
+
+async def run():
+    """Start the executor and queue withdrawals left pending by the previous run.
+
+    Only the leader process runs the executor, it polls for the withdrawals created by the others.
+    """
+    global queue, worker_tasks, poll_task, refresh_task, queued
+    await shutdown()
+    await allocator.load()
+    if not sharding.leader():
+        return
+    queue = asyncio.Queue()
+    pending = await e.objects.execute(
+        e.Withdrawal.select(e.Withdrawal.id).where(e.Withdrawal.state == e.Withdrawal.PENDING).order_by(e.Withdrawal.id)
+    )
+    for withdrawal in pending:
+        queue.put_nowait(withdrawal.id)
+    queued = {withdrawal.id for withdrawal in pending}
+    unconfirmed = await e.objects.count(e.Withdrawal.select().where(e.Withdrawal.state == e.Withdrawal.SENT))
+    if unconfirmed:
+        logger.warning('%d withdrawals were sent without confirmation and need a manual check', unconfirmed)
+    worker_tasks = [asyncio.create_task(worker()) for _ in range(max(len(allocator.slots), 1))]
+    if sharding.sharded():
+        poll_task = asyncio.create_task(sharding.poll('payouts', pending_withdrawals, queued, queue.put))
+        refresh_task = asyncio.create_task(refresh_wallets())
+    logger.info('Payouts are running, %d pending', len(pending))
+
+
+async def shutdown():
+    global worker_tasks, poll_task, refresh_task
+    if not worker_tasks:
+        return
+    tasks = worker_tasks + [task for task in (poll_task, refresh_task) if task]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    worker_tasks = []
+    poll_task = None
+    refresh_task = None
+    logger.info('Payouts are terminated')
+
+
+def submit(withdrawal_id):
+    if queue is None:
+        # Payouts run in the leader process
+        return
+    queued.add(withdrawal_id)
+    queue.put_nowait(withdrawal_id)
+
+
+async def refresh_wallets():
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL)
+        try:
+            await allocator.refresh()
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            prometheus.errors.inc('payouts')
+            logger.exception('Wallet refresh exception: %r', err)
+
+
+async def pending_withdrawals():
+    rows = await e.objects.execute(
+        e.Withdrawal.select(e.Withdrawal.id).where(e.Withdrawal.state == e.Withdrawal.PENDING).order_by(e.Withdrawal.id)
+    )
+    return [row.id for row in rows]
+
+
+async def next_batch():
+    """Wait for a withdrawal, then collect more for up to BATCH_WINDOW seconds or BATCH_SIZE withdrawals."""
+    batch = [await queue.get()]
+    deadline = asyncio.get_running_loop().time() + BATCH_WINDOW
+    while len(batch) < BATCH_SIZE:
+        timeout = deadline - asyncio.get_running_loop().time()
+        try:
+            if timeout > 0:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            else:
+                batch.append(queue.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            break
+    return batch
+
+
+async def worker():
+    while True:
+        batch = await next_batch()
+        try:
+            await execute(batch)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            # Stays in queued, so it isn't polled again until the next run, as with one process
+            prometheus.errors.inc('payouts')
+            logger.exception('Withdrawals %s exception: %r', batch, err)
+        else:
+            queued.difference_update(batch)
+
+
+async def set_state(withdrawals, state, error=None):
+    updated = ton.now_utc()
+    for withdrawal in withdrawals:
+        withdrawal.state = state
+        withdrawal.error = error
+        withdrawal.updated = updated
+    await e.objects.execute(e.Withdrawal.update(
+        state=state, error=error, updated=updated
+    ).where(
+        e.Withdrawal.id.in_([withdrawal.id for withdrawal in withdrawals])
+    ))
+    prometheus.withdrawals.inc(state, amount=len(withdrawals))
+
+
+async def send(slot, withdrawals, transactions):
+    if len(withdrawals) == 1:
+        return await gateway.send(
+            from_address=slot.wallet.address, private_key=slot.wallet.private_key,
+            to_address=withdrawals[0].address, amount=transactions[withdrawals[0].transaction_id].amount,
+        )
+    return await gateway.send_batch(
+        from_address=slot.wallet.address, private_key=slot.wallet.private_key,
+        transfers=[{
+            'to_address': withdrawal.address,
+            'amount': transactions[withdrawal.transaction_id].amount,
+        } for withdrawal in withdrawals],
+    )
+
+
+async def execute(withdrawal_ids):
+    """Send pending withdrawals as one transfer from one wallet."""
+    withdrawals = list(await e.objects.execute(e.Withdrawal.select().where(
+        e.Withdrawal.id.in_(withdrawal_ids), e.Withdrawal.state == e.Withdrawal.PENDING
+    ).order_by(e.Withdrawal.id)))
+    if not withdrawals:
+        return
+    transactions = {transaction.rowid: transaction for transaction in await e.objects.execute(
+        e.Transaction.select().where(e.Transaction.rowid.in_([withdrawal.transaction_id for withdrawal in withdrawals]))
+    )}
+    # Queued before addresses were checked, the gateway would fail the whole batch on any of them
+    invalid = [withdrawal for withdrawal in withdrawals if not ton.valid_address(withdrawal.address)]
+    for withdrawal in invalid:
+        transaction = transactions.pop(withdrawal.transaction_id)
+        await fail([withdrawal], {transaction.rowid: transaction}, transaction.wallet_id, 'Invalid address')
+        withdrawals.remove(withdrawal)
+    if withdrawals:
+        await transfer(withdrawal_ids, withdrawals, transactions)
+    # Only once every state change is committed
+    await notify(invalid + withdrawals)
+
+
+async def transfer(withdrawal_ids, withdrawals, transactions):
+    transaction_ids = [withdrawal.transaction_id for withdrawal in withdrawals]
+    total = sum(transaction.amount for transaction in transactions.values())
+    async with allocator.reserve(total) as slot:
+        async with e.objects.atomic():
+            await e.objects.execute(
+                e.Transaction.update(wallet=slot.wallet.id).where(e.Transaction.rowid.in_(transaction_ids))
+            )
+            await set_state(withdrawals, e.Withdrawal.SENT)
+        try:
+            sent_result = await send(slot, withdrawals, transactions)
+        except Exception as err:
+            if not gateway.not_sent(err):
+                # May be on chain already, refunding could pay twice
+                logger.exception('Withdrawals %s are not confirmed: %r', withdrawal_ids, err)
+                await set_state(withdrawals, e.Withdrawal.SENT, repr(err))
+            else:
+                allocator.credit(slot.wallet.id, total)
+                await fail(withdrawals, transactions, slot.wallet.id, repr(err))
+        else:
+            allocator.confirmed(slot, sent_result['seqno'])
+            async with e.objects.atomic():
+                await e.objects.execute(
+                    e.Transaction.update(seqno=sent_result['seqno']).where(e.Transaction.rowid.in_(transaction_ids))
+                )
+                await set_state(withdrawals, e.Withdrawal.CONFIRMED)
+
+
+async def notify(withdrawals):
+    """Report the states to the users, a report that fails is only logged and never holds up payouts."""
+    for withdrawal in withdrawals:
+        try:
+            await bot.update_withdrawal(withdrawal)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            prometheus.errors.inc('payouts')
+            logger.exception('Withdrawal %s notification exception: %r', withdrawal.id, err)
+
+
+async def fail(withdrawals, transactions, wallet_id, error):
+    logger.error('Withdrawals %s failed: %s', [withdrawal.id for withdrawal in withdrawals], error)
+    async with e.objects.atomic():
+        for withdrawal in withdrawals:
+            transaction = transactions[withdrawal.transaction_id]
+            await e.objects.execute(e.User.update(
+                {e.User.balance: e.User.balance + transaction.amount}
+            ).where(
+                e.User.id == transaction.user_id
+            ))
+        # Negative withdrawal rows cancel the debits, so the ledger stays append-only
+        await e.objects.execute(e.Transaction.insert_many([{
+            'user_id': transaction.user_id,
+            'date': ton.now_utc(),
+            'amount': -transaction.amount,
+            'wallet': wallet_id,
+        } for transaction in transactions.values()]))
+        await set_state(withdrawals, e.Withdrawal.FAILED, error)
+    refunds = Counter()
+    for transaction in transactions.values():
+        refunds[transaction.user_id] += transaction.amount
+    balances.apply(refunds)
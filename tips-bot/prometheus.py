@@ -0,0 +1,170 @@
+"""Process metrics in the Prometheus text format.
+
+Nothing is recorded unless ENABLED is set, so instrumented code only pays for a flag check when metrics are off.
+Gauges are computed by callbacks at scrape time.
+"""
+import functools
+import time
+
+ENABLED = False
+PREFIX = 'tipsbot_'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+registry = []
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = (f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry.append(self)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        if ENABLED:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def collect(self):
+        return [f'{self.name}{format_labels(self.labelnames, labels)} {value}' for labels, value in self.values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets=LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        # labels -> [count per bucket..., +Inf count, sum]
+        self.series = {}
+
+    def observe(self, value, *labels):
+        if not ENABLED:
+            return
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        else:
+            series[-2] += 1
+        series[-1] += value
+
+    def time(self, *labels):
+        return Timer(self, labels) if ENABLED else NULL_TIMER
+
+    def timed(self, *labels):
+        """Decorator timing a coroutine function."""
+        def decorator(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                if not ENABLED:
+                    return await function(*args, **kwargs)
+                with Timer(self, labels):
+                    return await function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def collect(self):
+        lines = []
+        for labels, series in self.series.items():
+            names = self.labelnames + ('le',)
+            count = 0
+            for bound, observed in zip(self.buckets + ('+Inf',), series):
+                count += observed
+                lines.append(f'{self.name}_bucket{format_labels(names, labels + (bound,))} {count}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {series[-1]}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+class Gauge(Metric):
+    """Value computed at scrape time by ``function``, a number or a mapping of label tuples to numbers."""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def collect(self):
+        values = self.function()
+        if values is None:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f'{self.name}{format_labels(self.labelnames, labels)} {value}' for labels, value in values.items()]
+
+
+class Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def render():
+    lines = []
+    for metric in registry:
+        try:
+            samples = metric.collect()
+        except Exception as err:
+            samples = [f'# {metric.name} failed: {err!r}']
+        lines += metric.header() + samples
+    return '\n'.join(lines) + '\n'
+
+
+bot_api_seconds = Histogram('bot_api_seconds', 'Bot API call latency', ['method'])
+gateway_seconds = Histogram('gateway_seconds', 'TON gateway request latency', ['endpoint'])
+sql_seconds = Histogram('sql_seconds', 'SQL statement latency, including the wait for a connection', ['statement'])
+handler_seconds = Histogram('handler_seconds', 'Telegram update handler latency', ['handler'])
+tips = Counter('tips_total', 'Stored tips')
+tips_nanotons = Counter('tips_nanotons_total', 'Amount of stored tips')
+payments_parked = Counter('payments_parked_total', 'Payments that could not be credited')
+withdrawals = Counter('withdrawals_total', 'Withdrawals by outcome', ['state'])
+errors = Counter('errors_total', 'Errors by component', ['component'])
+ledger_mismatches = Counter('ledger_mismatches_total', 'Balances and invoice totals off the ledger', ['kind'])
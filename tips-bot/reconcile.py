@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""Checks User.balance and Invoice.funded against the transaction ledger, and optionally repairs them.
+
+    ./reconcile.py config.json [--repair] [--incremental] [--fee PERCENT]
+
+A full run streams the whole ledger in rowid chunks, memory grows with the number of users and invoices only. An
+incremental run only checks the users and invoices with transactions after the checkpoint saved by the previous one,
+which is what the bot does in the background every INTERVAL seconds, differences it doesn't repair are left to the
+next full run. Suspected differences are summed up again outside of any transaction, and only the ones that remain
+are confirmed, and repaired, in a short transaction that holds their rows, so tips stored meanwhile are never
+overwritten.
+
+Tips are split with one fee for the whole ledger, the current one unless --fee is given.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+from collections import Counter
+from typing import Optional
+
+from peewee import Case
+
+import balances
+import entities as e
+import money
+import prometheus
+import sharding
+import ton
+
+CHUNK_SIZE = 5000
+BATCH_SIZE = 500
+REPORT_LIMIT = 100
+INTERVAL = 0.0
+REPAIR = False
+CHECKPOINT_KEY = 'reconcile_rowid'
+USERS = 'users'
+INVOICES = 'invoices'
+
+logger = logging.getLogger(__name__)
+task: Optional[asyncio.Task] = None
+
+
+async def run():
+    """Start the incremental checks, if INTERVAL is set, in the leader process."""
+    global task
+    await shutdown()
+    if INTERVAL > 0 and sharding.leader():
+        task = asyncio.create_task(reconcile_loop())
+
+
+async def shutdown():
+    global task
+    if not isinstance(task, asyncio.Task):
+        return
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    task = None
+
+
+class Ledger:
+    """User balances and invoice totals implied by transaction rows."""
+
+    def __init__(self, fee_bps):
+        self.fee_bps = fee_bps
+        self.balances = Counter()
+        self.funded = Counter()
+        self.count = 0
+
+    def add(self, rows):
+        for _, user_id, invoice_id, amount in rows:
+            if invoice_id is None:
+                # Withdrawals, and the negative rows cancelling failed ones
+                self.balances[user_id] -= amount
+            else:
+                self.balances[user_id] += money.split(amount, self.fee_bps)[0]
+                self.funded[invoice_id] += amount
+        self.count += len(rows)
+
+    def expected(self, kind):
+        return self.balances if kind == USERS else self.funded
+
+
+def stored_field(kind):
+    return (e.User, e.User.balance) if kind == USERS else (e.Invoice, e.Invoice.funded)
+
+
+async def transactions(after=0, until=None, where=None):
+    """Yield chunks of (rowid, user_id, invoice_id, amount) in rowid order, each chunk is its own query."""
+    while True:
+        query = e.Transaction.select(
+            e.Transaction.rowid, e.Transaction.user_id, e.Transaction.invoice, e.Transaction.amount
+        ).where(e.Transaction.rowid > after)
+        if until is not None:
+            query = query.where(e.Transaction.rowid <= until)
+        if where is not None:
+            query = query.where(where)
+        rows = list(await e.objects.execute(query.order_by(e.Transaction.rowid).limit(CHUNK_SIZE).tuples()))
+        if not rows:
+            return
+        yield rows
+        after = rows[-1][0]
+
+
+async def stored_values(kind):
+    """Yield chunks of (id, stored value) of every user or invoice, in id order."""
+    model, field = stored_field(kind)
+    after = None
+    while True:
+        query = model.select(model.id, field).order_by(model.id).limit(CHUNK_SIZE)
+        if after is not None:
+            query = query.where(model.id > after)
+        rows = list(await e.objects.execute(query.tuples()))
+        if not rows:
+            return
+        yield rows
+        after = rows[-1][0]
+
+
+async def settle(kind, keys, fee_bps, repair):
+    """Recompute the keys from their own transactions, then recheck the ones that differ and repair them if asked.
+
+    The sums are read outside of any transaction. Only the differing keys are rechecked, and repaired, in a short
+    transaction that holds their rows, so tips stored meanwhile are never overwritten. Returns {key: (stored, expected)}
+    of the ones that still differ.
+    """
+    model, field = stored_field(kind)
+    column = e.Transaction.user_id if kind == USERS else e.Transaction.invoice
+    differences = {}
+    for batch in ton.chunks(sorted(keys), BATCH_SIZE):
+        until = await last_rowid()
+        ledger = Ledger(fee_bps)
+        async for rows in transactions(until=until, where=column.in_(batch)):
+            ledger.add(rows)
+        stored = dict(await e.objects.execute(model.select(model.id, field).where(model.id.in_(batch)).tuples()))
+        suspects = compare(batch, stored, ledger.expected(kind))
+        if not suspects:
+            continue
+        async with e.objects.atomic():
+            query = model.select(model.id, field).where(model.id.in_(list(suspects)))
+            if e.database.for_update:
+                # Postgres commits out of rowid order, but it only holds these rows while they are summed again
+                query = query.for_update()
+                ledger, until = Ledger(fee_bps), 0
+            stored = dict(await e.objects.execute(query.tuples()))
+            # Sqlite commits in rowid order, only the rows after the ones summed above can be new
+            async for rows in transactions(after=until, where=column.in_(list(suspects))):
+                ledger.add(rows)
+            found = compare(suspects, stored, ledger.expected(kind))
+            if repair and found:
+                await update(kind, found)
+        if repair and kind == USERS:
+            balances.apply({user_id: value - old for user_id, (old, value) in found.items()})
+        differences.update(found)
+    if differences:
+        prometheus.ledger_mismatches.inc(kind, amount=len(differences))
+    return differences
+
+
+def compare(keys, stored, expected):
+    return {
+        key: (stored.get(key, 0), expected.get(key, 0))
+        for key in keys if stored.get(key, 0) != expected.get(key, 0)
+    }
+
+
+async def last_rowid():
+    return await e.objects.scalar(e.Transaction.select(e.Transaction.rowid).order_by(
+        e.Transaction.rowid.desc()
+    ).limit(1)) or 0
+
+
+async def update(kind, differences):
+    model, field = stored_field(kind)
+    keys = list(differences)
+    if kind == USERS:
+        await e.objects.execute(e.User.insert_many([{'id': user_id} for user_id in keys]).on_conflict_ignore())
+    for batch in ton.chunks(keys):
+        await e.objects.execute(model.update(
+            {field: Case(model.id, [(key, differences[key][1]) for key in batch], field)}
+        ).where(model.id.in_(batch)))
+
+
+def report(kind, differences):
+    return {
+        'mismatched': len(differences),
+        'sample': [
+            {'id': key, 'stored': stored, 'expected': expected}
+            for key, (stored, expected) in list(differences.items())[:REPORT_LIMIT]
+        ],
+    }
+
+
+async def full(fee_bps=None, repair=False):
+    """Check every user and invoice, returns the report."""
+    fee_bps = ton.FEE_BPS if fee_bps is None else fee_bps
+    until = await last_rowid()
+    ledger = Ledger(fee_bps)
+    async for rows in transactions(until=until):
+        ledger.add(rows)
+    result = {'mode': 'full', 'until': until, 'transactions': ledger.count, 'repaired': repair}
+    for kind in (USERS, INVOICES):
+        expected = ledger.expected(kind)
+        suspects = set()
+        async for rows in stored_values(kind):
+            for key, value in rows:
+                if expected.pop(key, 0) != value:
+                    suspects.add(key)
+        # In the ledger but without a row
+        suspects.update(key for key, value in expected.items() if value)
+        # Transactions stored after the scan make suspects too, settle() sorts them out
+        result[kind] = report(kind, await settle(kind, suspects, fee_bps, repair))
+    return result
+
+
+async def incremental(fee_bps=None, repair=False):
+    """Check the users and invoices with transactions after the saved checkpoint, then move it."""
+    fee_bps = ton.FEE_BPS if fee_bps is None else fee_bps
+    checkpoint = int(await e.objects.scalar(
+        e.Setting.select(e.Setting.value).where(e.Setting.key == CHECKPOINT_KEY)
+    ) or 0)
+    users, invoices = set(), set()
+    last, count = checkpoint, 0
+    async for rows in transactions(after=checkpoint):
+        for _, user_id, invoice_id, _ in rows:
+            users.add(user_id)
+            if invoice_id is not None:
+                invoices.add(invoice_id)
+        last, count = rows[-1][0], count + len(rows)
+    result = {'mode': 'incremental', 'after': checkpoint, 'until': last, 'transactions': count, 'repaired': repair}
+    result[USERS] = report(USERS, await settle(USERS, users, fee_bps, repair))
+    result[INVOICES] = report(INVOICES, await settle(INVOICES, invoices, fee_bps, repair))
+    await e.objects.execute(e.Setting.insert(key=CHECKPOINT_KEY, value=str(last)).on_conflict(
+        conflict_target=[e.Setting.key], update={e.Setting.value: str(last)},
+    ))
+    return result
+
+
+async def reconcile_loop():
+    while True:
+        await asyncio.sleep(INTERVAL)
+        try:
+            result = await incremental(repair=REPAIR)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            prometheus.errors.inc('reconcile')
+            logger.exception('Reconciliation exception: %r', err)
+            continue
+        if result[USERS]['mismatched'] or result[INVOICES]['mismatched']:
+            logger.warning('Ledger mismatches: %s', json.dumps(result))
+
+
+async def command(args):
+    import main
+    config = main.load_config(args.config)
+    main.init_database(config)
+    fee = args.fee if args.fee is not None else config.get('fee')
+    fee_bps = money.percent_to_bps(fee) if fee is not None else ton.FEE_BPS
+    try:
+        result = await (incremental if args.incremental else full)(fee_bps, args.repair)
+    finally:
+        await e.objects.close()
+    print(json.dumps(result, indent=2))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config', type=str, default='config.json', nargs='?')
+    parser.add_argument('--repair', action='store_true', help='fix the stored values, not only report them')
+    parser.add_argument('--incremental', action='store_true', help='only check what changed since the last run')
+    parser.add_argument('--fee', type=str, help='fee percent the tips were split with, the configured one by default')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    result = asyncio.run(command(args))
+    if not args.repair and (result[USERS]['mismatched'] or result[INVOICES]['mismatched']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,17 @@
-import json
+import asyncio
+import hmac
 import logging
 
 from aiohttp import web
 
+import balances
+import bot
 import entities as e
-import ton
+import history
+import payouts
+import prometheus
+import stats
+import tracking
 
 logger = logging.getLogger(__name__)
 routes = web.RouteTableDef()
@@ -12,9 +19,9 @@ app = web.Application()
 runner = web.AppRunner(app, lingering_time=0)
 
 
-async def run(host, port):
+async def run(host, port, reuse_port=False):
     await runner.setup()
-    site = web.TCPSite(runner, host=host, port=port)
+    site = web.TCPSite(runner, host=host, port=port, reuse_port=reuse_port)
     await site.start()
     logger.info(f'Web server is running on {host}:{port}')
 
@@ -26,19 +33,106 @@ async def shutdown():
 
 @routes.post(r'/tracking')
 async def handle_tracking(request):
-    data = await request.json()
-    async with e.objects.atomic():
-        if 'nextTrackingState' in data:
-            await e.objects.execute(
-                e.Wallet.update(state=json.dumps(data['nextTrackingState'])).where(e.Wallet.address == data['address'])
-            )
-        for payment in data['payments']:
-            await ton.new_tip(
-                invoice_id=payment['message'],
-                address=data['address'],
-                amount=payment['amount'],
-            )
+    """Acknowledge the payments once they are stored, they are processed in the background."""
+    try:
+        await tracking.accept(await request.json())
+    except (ValueError, e.Wallet.DoesNotExist) as err:
+        raise web.HTTPBadRequest(text=str(err))
+    except tracking.Overloaded:
+        raise web.HTTPTooManyRequests(headers={'Retry-After': str(int(tracking.RETRY_DELAY))})
+    except tracking.Unavailable:
+        raise web.HTTPServiceUnavailable()
+    return web.Response(status=202, text='accepted')
+
+
+@routes.post(r'/telegram/{secret}')
+async def handle_telegram(request):
+    secret = bot.WEBHOOK_SECRET
+    if not secret or not hmac.compare_digest(request.match_info['secret'], secret) or not hmac.compare_digest(
+            request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), secret):
+        raise web.HTTPForbidden()
+    if bot.inbox_full():
+        raise web.HTTPTooManyRequests()
+    await bot.feed_update(await request.json())
     return web.Response(text='ok')
 
 
+@routes.get(r'/history/{scope:user|chat}/{key:-?\d+}')
+async def handle_history(request):
+    """Stream the transactions of a user or chat, ?after=rowid resumes an interrupted export."""
+    scope, key, query = request.match_info['scope'], int(request.match_info['key']), request.query
+    fmt = query.get('format', 'csv')
+    try:
+        history.verify(scope, key, query.get('expires', 0), query.get('signature', ''))
+        if fmt not in history.FORMATS:
+            raise ValueError(f'Unknown format: {fmt}')
+        after = int(query.get('after', 0))
+        limit = int(query['limit']) if 'limit' in query else None
+        since, until = history.parse_date(query.get('since')), history.parse_date(query.get('until'))
+    except PermissionError as err:
+        raise web.HTTPForbidden(text=str(err))
+    except ValueError as err:
+        raise web.HTTPBadRequest(text=str(err))
+    response = web.StreamResponse(headers={
+        'Content-Type': f'{history.FORMATS[fmt]}; charset=utf-8',
+        'Content-Disposition': f'attachment; filename="{scope}-{key}.{fmt}"',
+    })
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    await response.write(history.header(fmt).encode())
+    async for rows in history.chunks(scope, key, after=after, since=since, until=until, limit=limit):
+        await response.write(history.render(rows, fmt).encode())
+    await response.write_eof()
+    return response
+
+
+@routes.get(r'/stats/{chat_id:-?\d+}')
+async def handle_stats(request):
+    chat_id = int(request.match_info['chat_id'])
+    try:
+        history.verify(stats.SCOPE, chat_id, request.query.get('expires', 0), request.query.get('signature', ''))
+    except PermissionError as err:
+        raise web.HTTPForbidden(text=str(err))
+    except ValueError as err:
+        raise web.HTTPBadRequest(text=str(err))
+    return web.json_response(await stats.chat_summary(chat_id))
+
+
+@routes.get(r'/metrics')
+async def handle_metrics(request):
+    if not prometheus.ENABLED:
+        raise web.HTTPNotFound()
+    return web.Response(text=prometheus.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Prometheus-Exposition-Format': '0.0.4'})
+
+
+def database_connections():
+    stats = e.database.pool_stats() if hasattr(e.database, 'pool_stats') else None
+    if stats is None:
+        return None
+    values = {('reader', 'idle'): stats['readers_idle'], ('writer', 'idle'): stats['writer_idle']}
+    values.update({(role, 'waiting'): stats[role]['waiting'] for role in ('reader', 'writer')})
+    return values
+
+
+def dispatcher_pending():
+    return bot.dispatcher and bot.dispatcher.pending
+
+
+def scheduler_queued():
+    return bot.scheduler and {(priority,): count for priority, count in bot.scheduler.metrics()['queued'].items()}
+
+
+prometheus.Gauge('asyncio_tasks', 'Running asyncio tasks', lambda: len(asyncio.all_tasks()))
+prometheus.Gauge('database_connections', 'Idle connections and waiting queries by pool', database_connections,
+                 ['pool', 'state'])
+prometheus.Gauge('dispatcher_pending', 'Telegram updates waiting for a handler', dispatcher_pending)
+prometheus.Gauge('inbox_updates', 'Telegram updates stored in the inbox', lambda: bot.inbox and bot.inbox.qsize())
+prometheus.Gauge('tracking_pending', 'Tracking batches waiting to be processed', lambda: tracking.pending)
+prometheus.Gauge('outbound_queued', 'Bot API calls waiting for the rate limiter', scheduler_queued, ['priority'])
+prometheus.Gauge('balance_cache_size', 'Cached balances', lambda: len(balances.cache))
+prometheus.Gauge('balance_cache_hit_rate', 'Balance cache hit rate', lambda: balances.cache.hit_rate())
+prometheus.Gauge('wallets_busy', 'Transfers in flight per hot wallet',
+                 lambda: {(slot.wallet.address,): slot.busy for slot in payouts.allocator.slots.values()}, ['wallet'])
+
 app.add_routes(routes)
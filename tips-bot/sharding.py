@@ -0,0 +1,52 @@
+"""Work split between several bot processes sharing a Postgres database.
+
+Process INDEX out of COUNT handles the Telegram updates and tracking batches of the chats it owns, rows stored by any
+process are picked up by their owner with ``poll``. The leader also runs what must stay single: Telegram polling,
+gateway tracking and payouts. With one process (the default) everything is handled in place and nothing is polled.
+"""
+import asyncio
+import logging
+
+from peewee import fn
+
+INDEX = 0
+COUNT = 1
+POLL_INTERVAL = 0.2
+
+logger = logging.getLogger(__name__)
+
+
+def sharded():
+    return COUNT > 1
+
+
+def leader():
+    return INDEX == 0
+
+
+def owns(chat_id):
+    return abs(chat_id or 0) % COUNT == INDEX
+
+
+def owned(chat_id_field):
+    """SQL condition matching the rows of this process, rows without a chat belong to the leader."""
+    return fn.MOD(fn.ABS(fn.COALESCE(chat_id_field, 0)), COUNT) == INDEX
+
+
+async def poll(name, load, queued, put):
+    """Every POLL_INTERVAL, put the keys returned by load that are not in queued yet, and add them to it.
+
+    The caller discards keys from queued once they are done with. A key finished while load was in flight can be put
+    again, so put, or whatever takes the key, must check that it still needs handling.
+    """
+    while True:
+        try:
+            for key in await load():
+                if key not in queued:
+                    queued.add(key)
+                    await put(key)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.exception('%s poll exception: %r', name, err)
+        await asyncio.sleep(POLL_INTERVAL)
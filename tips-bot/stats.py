@@ -0,0 +1,108 @@
+"""Tip totals per chat and per chat and day, kept in step with the tips by ton.store_tips.
+
+Reading them is a few primary key lookups, top invoices come from the (chat_id, funded) index of Invoice.
+"""
+from datetime import datetime, timezone
+
+from peewee import EXCLUDED
+
+import entities as e
+import history
+
+TOP_SIZE = 5
+DAYS = 7
+DAY_SECONDS = 24 * 3600
+SCOPE = 'stats'
+
+REBUILD = (
+    'DELETE FROM "chat_stats"',
+    'DELETE FROM "chat_day"',
+    'INSERT INTO "chat_stats" ("chat_id", "owner_id", "tips", "amount") '
+    'SELECT "i"."chat_id", 0, COUNT(*), SUM("t"."amount") '
+    'FROM "transaction" AS "t" JOIN "invoice" AS "i" ON "i"."id" = "t"."invoice_id" '
+    'GROUP BY "i"."chat_id"',
+    'UPDATE "chat_stats" SET "owner_id" = ('
+    'SELECT "t"."user_id" FROM "transaction" AS "t" JOIN "invoice" AS "i" ON "i"."id" = "t"."invoice_id" '
+    'WHERE "i"."chat_id" = "chat_stats"."chat_id" ORDER BY "t"."rowid" DESC LIMIT 1)',
+    'INSERT INTO "chat_day" ("chat_id", "day", "tips", "amount") '
+    f'SELECT "i"."chat_id", CAST("t"."date" / {DAY_SECONDS} AS INTEGER), COUNT(*), SUM("t"."amount") '
+    'FROM "transaction" AS "t" JOIN "invoice" AS "i" ON "i"."id" = "t"."invoice_id" '
+    'GROUP BY 1, 2',
+)
+
+
+def day_of(date):
+    return int(date.timestamp() // DAY_SECONDS)
+
+
+def rebuild(database):
+    """Recompute every total from the transactions, synchronously and in the caller's transaction."""
+    for sql in REBUILD:
+        database.execute_sql(sql)
+
+
+async def record(rows):
+    """Add stored tip rows to the totals of their chats inside the caller's transaction."""
+    chats = {}
+    days = {}
+    for row in rows:
+        chat_id = row['chat_id']
+        tips, amount, _ = chats.get(chat_id, (0, 0, None))
+        chats[chat_id] = (tips + 1, amount + row['amount'], row['user_id'])
+        key = chat_id, day_of(row['date'])
+        tips, amount = days.get(key, (0, 0))
+        days[key] = (tips + 1, amount + row['amount'])
+    if not chats:
+        return
+    await e.objects.execute(e.ChatStats.insert_many([
+        {'chat_id': chat_id, 'owner_id': owner_id, 'tips': tips, 'amount': amount}
+        for chat_id, (tips, amount, owner_id) in chats.items()
+    ]).on_conflict(conflict_target=[e.ChatStats.chat_id], update={
+        e.ChatStats.owner_id: EXCLUDED.owner_id,
+        e.ChatStats.tips: e.ChatStats.tips + EXCLUDED.tips,
+        e.ChatStats.amount: e.ChatStats.amount + EXCLUDED.amount,
+    }))
+    await e.objects.execute(e.ChatDay.insert_many([
+        {'chat_id': chat_id, 'day': day, 'tips': tips, 'amount': amount}
+        for (chat_id, day), (tips, amount) in days.items()
+    ]).on_conflict(conflict_target=[e.ChatDay.chat_id, e.ChatDay.day], update={
+        e.ChatDay.tips: e.ChatDay.tips + EXCLUDED.tips,
+        e.ChatDay.amount: e.ChatDay.amount + EXCLUDED.amount,
+    }))
+
+
+def link(chat_id):
+    return f'{history.URL}/stats/{chat_id}?{history.signed_query(SCOPE, chat_id)}'
+
+
+async def owned_chats(user_id):
+    """Chats whose latest tip went to the user."""
+    rows = await e.objects.execute(e.ChatStats.select(e.ChatStats.chat_id).where(e.ChatStats.owner_id == user_id))
+    return [row.chat_id for row in rows]
+
+
+async def chat_summary(chat_id):
+    """Totals, the last DAYS days and the TOP_SIZE best funded invoices of a chat, amounts in nanotons."""
+    totals = await e.objects.execute(e.ChatStats.select().where(e.ChatStats.chat_id == chat_id))
+    today = day_of(datetime.now(timezone.utc))
+    days = await e.objects.execute(e.ChatDay.select().where(
+        e.ChatDay.chat_id == chat_id, e.ChatDay.day > today - DAYS
+    ).order_by(e.ChatDay.day))
+    top = await e.objects.execute(e.Invoice.select(e.Invoice.id, e.Invoice.message_id, e.Invoice.funded).where(
+        e.Invoice.chat_id == chat_id, e.Invoice.funded > 0
+    ).order_by(e.Invoice.funded.desc()).limit(TOP_SIZE))
+    today_row = next((day for day in days if day.day == today), None)
+    return {
+        'chat_id': chat_id,
+        'tips': totals[0].tips if totals else 0,
+        'amount': totals[0].amount if totals else 0,
+        'today': {'tips': today_row.tips, 'amount': today_row.amount} if today_row else {'tips': 0, 'amount': 0},
+        'days': [{
+            'date': datetime.fromtimestamp(day.day * DAY_SECONDS, timezone.utc).date().isoformat(),
+            'tips': day.tips,
+            'amount': day.amount,
+        } for day in days],
+        'top': [
+            {'invoice_id': invoice.id, 'message_id': invoice.message_id, 'amount': invoice.funded} for invoice in top
+        ],
+    }
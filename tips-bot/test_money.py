@@ -0,0 +1,75 @@
+"""Property checks of money.py: fee splits and display never create or lose nanotons.
+
+    python -m pytest test_money.py
+"""
+import random
+
+import pytest
+
+import money
+
+FEES_BPS = (0, 1, 100, 250, 9999, money.BPS)
+EDGE_AMOUNTS = [0, 1, 2, 99, 100, 101, money.BPS - 1, money.BPS, money.BPS + 1, money.NANO - 1, money.NANO,
+                money.NANO + 1, 10 ** 18, 2 ** 63 - 1]
+
+
+def amounts(count=10000, seed=1):
+    generator = random.Random(seed)
+    return EDGE_AMOUNTS + [generator.randrange(1, 10 ** 12) for _ in range(count)]
+
+
+@pytest.mark.parametrize('fee_bps', FEES_BPS)
+def test_split_adds_up(fee_bps):
+    for amount in amounts():
+        share, fee = money.split(amount, fee_bps)
+        assert share + fee == amount
+        assert 0 <= share <= amount
+        assert 0 <= fee <= amount
+
+
+@pytest.mark.parametrize('fee_bps', FEES_BPS)
+def test_split_many_matches_split(fee_bps):
+    values = amounts()
+    shares, fee = money.split_many(values, fee_bps)
+    assert sum(shares) + fee == sum(values)
+    assert shares == [money.split(amount, fee_bps)[0] for amount in values]
+
+
+def test_split_rounds_the_share_down():
+    assert money.split(1, 100) == (0, 1)
+    assert money.split(199, 100) == (197, 2)
+    assert money.split(money.NANO, 0) == (money.NANO, 0)
+    assert money.split(money.NANO, money.BPS) == (0, money.NANO)
+
+
+def test_display_round_trips_at_full_precision():
+    for amount in amounts(seed=2):
+        assert money.to_nano(money.display(amount, decimals=money.DECIMALS)) == amount
+
+
+def test_display_never_shows_more_than_the_amount():
+    for amount in amounts(seed=3):
+        assert money.to_nano(money.display(amount)) <= amount
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('0.5', money.NANO // 2),
+    ('1', money.NANO),
+    ('0.000000001', 1),
+    ('2.50', 2 * money.NANO + money.NANO // 2),
+])
+def test_to_nano(value, expected):
+    assert money.to_nano(value) == expected
+
+
+@pytest.mark.parametrize('value', ['-1', '1e3', '', '0.0000000001', 'abc'])
+def test_to_nano_rejects(value):
+    with pytest.raises(ValueError):
+        money.to_nano(value)
+
+
+def test_percent_to_bps():
+    assert money.percent_to_bps('1') == 100
+    assert money.percent_to_bps('0.25') == 25
+    with pytest.raises(ValueError):
+        money.percent_to_bps('0.125')
@@ -26,9 +26,121 @@ CREATE TABLE IF NOT EXISTS "transaction" (
 	"wallet_id"	INTEGER NOT NULL,
 	"invoice_id"	TEXT,
 	"seqno"	TEXT,
+	"lt"	TEXT,
+	"hash"	TEXT,
+	"chat_id"	INTEGER,
 	FOREIGN KEY("invoice_id") REFERENCES "invoice"("id"),
 	FOREIGN KEY("wallet_id") REFERENCES "wallet"("id")
 );
+CREATE TABLE IF NOT EXISTS "withdrawal" (
+	"id"	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	"transaction_id"	INTEGER NOT NULL,
+	"address"	TEXT NOT NULL,
+	"state"	TEXT NOT NULL DEFAULT 'pending',
+	"chat_id"	INTEGER,
+	"message_id"	INTEGER,
+	"updated"	INTEGER NOT NULL,
+	"error"	TEXT,
+	"request_chat_id"	INTEGER,
+	"request_message_id"	INTEGER,
+	FOREIGN KEY("transaction_id") REFERENCES "transaction"("rowid")
+);
+CREATE TABLE IF NOT EXISTS "chat" (
+	"id"	INTEGER NOT NULL,
+	"owner_id"	INTEGER NOT NULL,
+	"updated"	INTEGER NOT NULL,
+	PRIMARY KEY("id")
+);
+CREATE TABLE IF NOT EXISTS "tracking_batch" (
+	"id"	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	"address"	TEXT NOT NULL,
+	"payments"	TEXT NOT NULL,
+	"received"	INTEGER NOT NULL,
+	"chat_id"	INTEGER
+);
+CREATE TABLE IF NOT EXISTS "parked_payment" (
+	"id"	INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	"address"	TEXT NOT NULL,
+	"payment"	TEXT NOT NULL,
+	"chat_id"	INTEGER,
+	"hash"	TEXT,
+	"error"	TEXT NOT NULL,
+	"parked"	INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS "inbox_update" (
+	"update_id"	INTEGER NOT NULL,
+	"data"	TEXT NOT NULL,
+	"chat_id"	INTEGER,
+	"done"	INTEGER,
+	PRIMARY KEY("update_id")
+);
+CREATE TABLE IF NOT EXISTS "setting" (
+	"key"	TEXT NOT NULL,
+	"value"	TEXT NOT NULL,
+	PRIMARY KEY("key")
+);
+CREATE TABLE IF NOT EXISTS "chat_stats" (
+	"chat_id"	INTEGER NOT NULL,
+	"owner_id"	INTEGER NOT NULL,
+	"tips"	INTEGER NOT NULL,
+	"amount"	INTEGER NOT NULL,
+	PRIMARY KEY("chat_id")
+);
+CREATE TABLE IF NOT EXISTS "chat_day" (
+	"chat_id"	INTEGER NOT NULL,
+	"day"	INTEGER NOT NULL,
+	"tips"	INTEGER NOT NULL,
+	"amount"	INTEGER NOT NULL,
+	PRIMARY KEY("chat_id","day")
+);
+CREATE INDEX IF NOT EXISTS "transaction_user_id_rowid_date" ON "transaction" (
+	"user_id",
+	"rowid",
+	"date"
+);
+CREATE INDEX IF NOT EXISTS "transaction_invoice_id_rowid_date" ON "transaction" (
+	"invoice_id",
+	"rowid",
+	"date"
+);
+CREATE INDEX IF NOT EXISTS "transaction_chat_id_rowid_date" ON "transaction" (
+	"chat_id",
+	"rowid",
+	"date"
+);
+CREATE INDEX IF NOT EXISTS "transaction_wallet_id" ON "transaction" (
+	"wallet_id"
+);
+CREATE INDEX IF NOT EXISTS "invoice_chat_id_message_id" ON "invoice" (
+	"chat_id",
+	"message_id"
+);
+CREATE INDEX IF NOT EXISTS "invoice_chat_id_funded" ON "invoice" (
+	"chat_id",
+	"funded"
+);
+CREATE INDEX IF NOT EXISTS "chatstats_owner_id" ON "chat_stats" (
+	"owner_id"
+);
+CREATE UNIQUE INDEX IF NOT EXISTS "transaction_hash" ON "transaction" (
+	"hash"
+);
+CREATE UNIQUE INDEX IF NOT EXISTS "parkedpayment_hash" ON "parked_payment" (
+	"hash"
+);
+CREATE INDEX IF NOT EXISTS "withdrawal_transaction_id" ON "withdrawal" (
+	"transaction_id"
+);
+CREATE INDEX IF NOT EXISTS "withdrawal_state" ON "withdrawal" (
+	"state"
+);
+CREATE UNIQUE INDEX IF NOT EXISTS "withdrawal_request_chat_id_request_message_id" ON "withdrawal" (
+	"request_chat_id",
+	"request_message_id"
+);
+CREATE INDEX IF NOT EXISTS "inboxupdate_done" ON "inbox_update" (
+	"done"
+);
 CREATE INDEX IF NOT EXISTS "wallet_address" ON "wallet" (
 	"address"
 );
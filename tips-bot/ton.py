@@ -1,31 +1,108 @@
+import asyncio
 import base64
+import binascii
+import contextlib
+import json
+import logging
+import re
 import struct
+from collections import Counter
 from datetime import datetime, timezone
-from decimal import Decimal
 
-from telegram.error import BadRequest
+from peewee import Case, IntegrityError
 
+import balances
 import bot
 import entities as e
-import gateway
+import money
+import payouts
+import prometheus
+import stats
+from cache import LRUCache
 
-FEE = Decimal('1')
-MIN_WITHDRAW = Decimal('0.5')
+FEE_BPS = 100
+MIN_WITHDRAW = money.NANO // 2
+BATCH_SIZE = 100
+RECENT_PAYMENTS = 100000
+RAW_ADDRESS = re.compile(r'^-?\d+:[0-9a-fA-F]{64}$')
+
+logger = logging.getLogger(__name__)
+# Hashes of recently stored payments, the unique index on Transaction.hash is the authority
+recent_payments = LRUCache(maxsize=RECENT_PAYMENTS)
+# user_id -> [lock, number of holders and waiters], entries are dropped once unused
+user_locks = {}
+
+
+class InsufficientFunds(Exception):
+    pass
+
+
+class InvalidAddress(ValueError):
+    pass
+
+
+class DuplicateWithdrawal(Exception):
+    """The request message has a withdrawal already."""
+
+
+@contextlib.asynccontextmanager
+async def user_lock(user_id):
+    """Serialize balance-changing operations of one user, different users don't wait for each other."""
+    entry = user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del user_locks[user_id]
+
+
+async def debit(user_id, amount):
+    """Subtract amount from the balance only if it covers it, raises InsufficientFunds otherwise.
+
+    The check and the update are one statement holding the user's row lock, so debits and credits made by other
+    processes at the same time can't overdraw it.
+    """
+    updated = await e.objects.execute(e.User.update(
+        {e.User.balance: e.User.balance - amount}
+    ).where(
+        (e.User.id == user_id) & (e.User.balance >= amount)
+    ))
+    if updated != 1:
+        raise InsufficientFunds(user_id, amount)
 
 
 async def gen_invoice_id(chat_id, message_id):
+    """Store the invoice of a post, unless a previous attempt did, and return its id."""
     data = struct.pack('<qi', chat_id, message_id)
     invoice_id = base64.urlsafe_b64encode(data).decode()
-    await e.objects.create(e.Invoice, id=invoice_id, chat_id=chat_id, message_id=message_id)
+    await e.objects.execute(
+        e.Invoice.insert(id=invoice_id, chat_id=chat_id, message_id=message_id).on_conflict_ignore()
+    )
     return invoice_id
 
 
-def int_to_ton(value):
-    return Decimal(value) / 10 ** 9
+def invoice_chat_id(invoice_id):
+    """Chat of an invoice id made by gen_invoice_id, None if it isn't one."""
+    try:
+        return struct.unpack('<qi', base64.urlsafe_b64decode(invoice_id))[0]
+    except (TypeError, ValueError, struct.error):
+        return None
 
 
-def ton_to_int(value):
-    return int(Decimal(value) * 10 ** 9)
+def valid_address(address):
+    """Whether the gateway's Address.parse accepts the address: workchain:hex, or the checksummed base64 form."""
+    if RAW_ADDRESS.match(address):
+        return True
+    if len(address) != 48:
+        return False
+    try:
+        data = base64.b64decode(address.replace('-', '+').replace('_', '/'), validate=True)
+    except binascii.Error:
+        return False
+    return data[0] & 0x7f in (0x11, 0x51) and struct.unpack('>H', data[34:])[0] == binascii.crc_hqx(data[:34], 0)
 
 
 def now_utc():
@@ -33,51 +110,217 @@ def now_utc():
 
 
 async def get_user_available_balance(user_id):
-    balance = await e.objects.scalar(e.User.select(e.User.balance).where(e.User.id == user_id)) or 0
-    return int_to_ton(balance)
+    """Balance in nanotons."""
+    return await balances.get(user_id)
 
 
-async def new_tip(*, invoice_id, address, amount):
-    invoice = await e.objects.get(e.Invoice, id=invoice_id)
-    user_id = await bot.get_chat_owner(invoice.chat_id)
+def chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def unseen_payments(payments):
+    """Drop payments repeated in the list or stored recently, a cheap pre-check before the database one."""
+    hashes = set()
+    result = []
+    for payment in payments:
+        payment_hash = payment.get('hash')
+        if payment_hash is not None:
+            if payment_hash in hashes or payment_hash in recent_payments:
+                logger.info('Duplicate payment: %r', payment)
+                continue
+            hashes.add(payment_hash)
+        result.append(payment)
+    return result
+
+
+async def resolve_tips(*, address, payments, final=False):
+    """Turn gateway payments into Transaction rows, doing every lookup up front and outside of any transaction.
+
+    Returns the rows and the ParkedPayment rows of the payments to chats whose owner can't be found. Other errors
+    finding an owner are raised for the whole batch to be retried, unless final is set and they are parked too.
+    """
+    payments = unseen_payments(payments)
     wallet = await e.objects.get(e.Wallet, address=address)
-    async with e.objects.atomic():
-        await e.objects.create(
-            e.Transaction,
-            user_id=user_id, date=now_utc(), amount=amount, wallet_id=wallet.id, invoice_id=invoice_id
-        )
-        await e.objects.execute(e.Invoice.update(
-            {e.Invoice.funded: e.Invoice.funded + amount}
-        ).where(
-            e.Invoice.id == invoice_id
+    invoice_ids = {payment['message'] for payment in payments}
+    invoices = {}
+    for ids in chunks(invoice_ids):
+        invoices.update((invoice.id, invoice) for invoice in await e.objects.execute(
+            e.Invoice.select(e.Invoice.id, e.Invoice.chat_id).where(e.Invoice.id.in_(ids))
         ))
-        user, _ = await e.objects.get_or_create(e.User, id=user_id)
-        user.balance += amount * (1 - FEE / 100)
-        await e.objects.update(user)
-    try:
-        await bot.update_funded(invoice_id)
-    except BadRequest:
-        pass
+    chat_ids = list({invoice.chat_id for invoice in invoices.values()})
+    # One chat that lost the bot mustn't hold up the payments to the others
+    owners = dict(zip(chat_ids, await asyncio.gather(*map(bot.get_chat_owner, chat_ids), return_exceptions=True)))
+    for owner in owners.values():
+        if isinstance(owner, BaseException) and not final and not isinstance(owner, bot.OWNER_UNAVAILABLE):
+            raise owner
+    date = now_utc()
+    rows = []
+    parked = []
+    for payment in payments:
+        invoice = invoices.get(payment['message'])
+        if invoice is None:
+            logger.warning('Payment to %s for unknown invoice: %r', address, payment)
+            continue
+        if isinstance(owners[invoice.chat_id], BaseException):
+            parked.append(parked_row(address, payment, invoice.chat_id, repr(owners[invoice.chat_id])))
+            continue
+        rows.append({
+            'user_id': owners[invoice.chat_id],
+            'date': date,
+            'amount': int(payment['amount']),
+            'wallet': wallet.id,
+            'invoice': invoice.id,
+            'chat_id': invoice.chat_id,
+            'lt': payment.get('lt'),
+            'hash': payment.get('hash'),
+        })
+    return rows, parked
 
 
-async def withdraw(*, user_id, address, amount):
-    amount = ton_to_int(amount)
-    wallet = await e.objects.get(e.Wallet.select().limit(1))
-    async with e.objects.atomic():
-        transaction = await e.objects.create(
-            e.Transaction,
-            user_id=user_id,
-            date=now_utc(),
-            amount=amount,
-            wallet_id=wallet.id,
-        )
+def parked_row(address, payment, chat_id, error):
+    return {
+        'address': address,
+        'payment': json.dumps(payment),
+        'chat_id': chat_id,
+        'hash': payment.get('hash'),
+        'error': error,
+        'parked': now_utc(),
+    }
+
+
+async def park(rows):
+    """Keep payments that can't be credited for a manual check, inside the caller's transaction."""
+    if not rows:
+        return
+    for batch in chunks(rows):
+        await e.objects.execute(e.ParkedPayment.insert_many(batch).on_conflict_ignore())
+    logger.error('Parked %d payments: %r', len(rows), rows)
+    prometheus.payments_parked.inc(amount=len(rows))
+
+
+class TipsUpdate:
+    """Totals of stored tips, applied to the in-memory state once their transaction commits."""
+
+    def __init__(self, rows):
+        self.funded = Counter()
+        self.balances = Counter()
+        self.received = Counter()
+        self.hashes = [row['hash'] for row in rows if row['hash'] is not None]
+        self.count = len(rows)
+        shares, _ = money.split_many([row['amount'] for row in rows], FEE_BPS)
+        for row, share in zip(rows, shares):
+            self.funded[row['invoice']] += row['amount']
+            self.balances[row['user_id']] += share
+            self.received[row['wallet']] += row['amount']
+
+    def committed(self):
+        """Must be called right after the commit without awaiting in between, returns the funded invoice ids."""
+        for payment_hash in self.hashes:
+            recent_payments.set(payment_hash, True)
+        prometheus.tips.inc(amount=self.count)
+        prometheus.tips_nanotons.inc(amount=sum(self.funded.values()))
+        balances.apply(self.balances)
+        for wallet_id, amount in self.received.items():
+            payouts.allocator.credit(wallet_id, amount)
+        return list(self.funded)
+
+
+async def drop_stored(rows):
+    stored = set()
+    for batch in chunks([row['hash'] for row in rows if row['hash'] is not None]):
+        stored.update(payment_hash for payment_hash, in await e.objects.execute(
+            e.Transaction.select(e.Transaction.hash).where(e.Transaction.hash.in_(batch)).tuples()
+        ))
+    if not stored:
+        return rows
+    logger.info('Skipping %d already stored payments', len(stored))
+    return [row for row in rows if row['hash'] not in stored]
+
+
+async def store_tips(rows):
+    """Store resolved tips with set-based updates of invoice, chat and user totals, inside the caller's transaction.
+
+    Payments that are already stored are skipped. Call committed() of the returned TipsUpdate after the commit.
+    """
+    rows = await drop_stored(rows)
+    update = TipsUpdate(rows)
+    for batch in chunks(rows):
+        await e.objects.execute(e.Transaction.insert_many(batch))
+    for batch in chunks(update.funded.items()):
+        await e.objects.execute(e.Invoice.update(
+            {e.Invoice.funded: e.Invoice.funded + Case(e.Invoice.id, batch, 0)}
+        ).where(
+            e.Invoice.id.in_([invoice_id for invoice_id, _ in batch])
+        ))
+    await stats.record(rows)
+    for batch in chunks(update.balances.items()):
+        user_ids = [user_id for user_id, _ in batch]
+        await e.objects.execute(e.User.insert_many([{'id': user_id} for user_id in user_ids]).on_conflict_ignore())
         await e.objects.execute(e.User.update(
-            {e.User.balance: e.User.balance - amount}
+            {e.User.balance: e.User.balance + Case(e.User.id, batch, 0)}
         ).where(
-            e.User.id == user_id
+            e.User.id.in_(user_ids)
         ))
-        sent_result = await gateway.send(
-            from_address=wallet.address, private_key=wallet.private_key, to_address=address, amount=amount
-        )
-        transaction.seqno = sent_result['seqno']
-        await e.objects.update(transaction)
+    return update
+
+
+async def save_tips(rows):
+    """Store resolved tips in their own transaction, returns the funded invoice ids."""
+    async with e.objects.atomic():
+        update = await store_tips(rows)
+    return update.committed()
+
+
+async def new_tip(*, invoice_id, address, amount):
+    rows, parked = await resolve_tips(address=address, payments=[{'message': invoice_id, 'amount': amount}])
+    funded = await save_tips(rows)
+    await park(parked)
+    for funded_id in funded:
+        await bot.update_funded(funded_id)
+
+
+async def withdrawal_requested(chat_id, message_id):
+    return await e.objects.count(e.Withdrawal.select().where(
+        e.Withdrawal.request_chat_id == chat_id, e.Withdrawal.request_message_id == message_id
+    )) > 0
+
+
+async def withdraw(*, user_id, address, amount, chat_id=None, message_id=None, request_chat_id=None,
+                   request_message_id=None):
+    """Debit the balance and queue the transfer of amount nanotons, the result is reported to chat_id/message_id later.
+
+    Raises InsufficientFunds, without any changes, if the balance doesn't cover the amount, InvalidAddress if the
+    gateway would reject the address, and DuplicateWithdrawal if the request message has one already.
+    """
+    if not valid_address(address):
+        raise InvalidAddress(address)
+    async with user_lock(user_id):
+        wallet = payouts.allocator.pick(amount).wallet
+        try:
+            async with e.objects.atomic():
+                await debit(user_id, amount)
+                transaction = await e.objects.create(
+                    e.Transaction,
+                    user_id=user_id,
+                    date=now_utc(),
+                    amount=amount,
+                    wallet_id=wallet.id,
+                )
+                withdrawal = await e.objects.create(
+                    e.Withdrawal,
+                    transaction=transaction.rowid,
+                    address=address,
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    updated=now_utc(),
+                    request_chat_id=request_chat_id,
+                    request_message_id=request_message_id,
+                )
+        except IntegrityError:
+            raise DuplicateWithdrawal(request_chat_id, request_message_id)
+        balances.apply({user_id: -amount})
+    prometheus.withdrawals.inc(e.Withdrawal.PENDING)
+    payouts.submit(withdrawal.id)
+    return withdrawal
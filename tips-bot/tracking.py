@@ -0,0 +1,209 @@
+import asyncio
+import json
+import logging
+from collections import Counter
+from typing import Optional
+
+import bot
+import entities as e
+import prometheus
+import sharding
+import ton
+
+MAX_PENDING = 1000
+CONSUMERS = 4
+RETRY_DELAY = 5.0
+# The last of these attempts parks the payments of chats without an owner instead of failing, if it fails anyway all
+# payments of the batch are parked. The delay doubles after each failure.
+MAX_ATTEMPTS = 8
+
+logger = logging.getLogger(__name__)
+queue: Optional[asyncio.Queue] = None
+consumer_tasks = []
+poll_task: Optional[asyncio.Task] = None
+pending = 0
+# Batch ids queued or being processed, when batches are shared between processes
+queued = set()
+# Failures of the batches being retried
+attempts = Counter()
+
+
+class Overloaded(Exception):
+    """Too many batches wait to be processed, the gateway should retry later."""
+
+
+class Unavailable(Exception):
+    """The consumers are not running."""
+
+
+async def run():
+    """Start the consumers and queue the batches left unprocessed by the previous run."""
+    global queue, consumer_tasks, poll_task, pending, queued, attempts
+    await shutdown()
+    queue = asyncio.Queue()
+    pending = 0
+    attempts = Counter()
+    if sharding.sharded():
+        queued = set()
+        poll_task = asyncio.create_task(sharding.poll('tracking', owned_batches, queued, put))
+    else:
+        batches = await e.objects.execute(e.TrackingBatch.select(e.TrackingBatch.id).order_by(e.TrackingBatch.id))
+        for batch in batches:
+            await put(batch.id)
+    consumer_tasks = [asyncio.create_task(consumer()) for _ in range(CONSUMERS)]
+    logger.info('Tracking consumers are running, %d batches pending', pending)
+    parked = await e.objects.count(e.ParkedPayment.select())
+    if parked:
+        logger.warning('%d payments are parked and need a manual check', parked)
+
+
+async def shutdown():
+    global queue, consumer_tasks, poll_task
+    queue = None
+    if not consumer_tasks:
+        return
+    tasks = consumer_tasks + ([poll_task] if poll_task else [])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    consumer_tasks = []
+    poll_task = None
+    logger.info('Tracking consumers are terminated')
+
+
+def validate(data):
+    """Raises ValueError unless data is a well-formed tracking callback."""
+    if not isinstance(data, dict) or not isinstance(data.get('address'), str):
+        raise ValueError('address is missing')
+    payments = data.get('payments')
+    if not isinstance(payments, list):
+        raise ValueError('payments is missing')
+    for payment in payments:
+        if not isinstance(payment, dict) or 'amount' not in payment:
+            raise ValueError(f'Incorrect payment: {payment!r}')
+        int(payment['amount'])
+
+
+async def accept(data):
+    """Durably store a tracking callback and queue its payments, returns once the batch is committed.
+
+    The wallet's next tracking state is stored in the same transaction, so the gateway may move on right away. With
+    several processes, payments are stored in one batch per chat, for the process owning the chat to poll.
+    """
+    if queue is None:
+        raise Unavailable()
+    if await backlog() >= MAX_PENDING:
+        raise Overloaded()
+    validate(data)
+    wallet = await e.objects.get(e.Wallet, address=data['address'])
+    payments = ton.unseen_payments(data['payments'])
+    groups = {}
+    if sharding.sharded():
+        for payment in payments:
+            groups.setdefault(ton.invoice_chat_id(payment.get('message')), []).append(payment)
+    elif payments:
+        groups[None] = payments
+    batches = []
+    async with e.objects.atomic():
+        if 'nextTrackingState' in data:
+            await e.objects.execute(
+                e.Wallet.update(state=json.dumps(data['nextTrackingState'])).where(e.Wallet.id == wallet.id)
+            )
+        for chat_id, group in groups.items():
+            batches.append(await e.objects.create(
+                e.TrackingBatch, address=wallet.address, payments=json.dumps(group), received=ton.now_utc(),
+                chat_id=chat_id,
+            ))
+    if not sharding.sharded():
+        for batch in batches:
+            await put(batch.id)
+
+
+async def backlog():
+    """Batches waiting to be processed, by any process when they are shared."""
+    if sharding.sharded():
+        # Callbacks reach any process, while each one only counts the batches of its own chats
+        return await e.objects.count(e.TrackingBatch.select())
+    return pending
+
+
+async def put(batch_id):
+    global pending
+    pending += 1
+    queue.put_nowait(batch_id)
+
+
+async def owned_batches():
+    rows = await e.objects.execute(e.TrackingBatch.select(e.TrackingBatch.id).where(
+        sharding.owned(e.TrackingBatch.chat_id)
+    ).order_by(e.TrackingBatch.id))
+    return [row.id for row in rows]
+
+
+async def process(batch_id, final=False):
+    """Store the tips of a batch, final parks the payments of any chat whose owner can't be found."""
+    try:
+        batch = await e.objects.get(e.TrackingBatch, id=batch_id)
+    except e.TrackingBatch.DoesNotExist:
+        # Processed already, polled again by a poll that was in flight meanwhile
+        return
+    tips, parked = await ton.resolve_tips(address=batch.address, payments=json.loads(batch.payments), final=final)
+    async with e.objects.atomic():
+        update = await ton.store_tips(tips)
+        await ton.park(parked)
+        await e.objects.execute(e.TrackingBatch.delete().where(e.TrackingBatch.id == batch_id))
+    for invoice_id in update.committed():
+        await bot.update_funded(invoice_id)
+
+
+async def dead_letter(batch_id, error):
+    """Park all payments of a batch whose final attempt failed too and drop it."""
+    try:
+        batch = await e.objects.get(e.TrackingBatch, id=batch_id)
+    except e.TrackingBatch.DoesNotExist:
+        return
+    async with e.objects.atomic():
+        await ton.park([
+            ton.parked_row(batch.address, payment, ton.invoice_chat_id(payment.get('message')), error)
+            for payment in json.loads(batch.payments)
+        ])
+        await e.objects.execute(e.TrackingBatch.delete().where(e.TrackingBatch.id == batch_id))
+
+
+async def consumer():
+    global pending
+    while True:
+        batch_id = await queue.get()
+        try:
+            await process(batch_id, final=attempts[batch_id] >= MAX_ATTEMPTS - 1)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            prometheus.errors.inc('tracking')
+            logger.exception('Tracking batch %s exception: %r', batch_id, err)
+            attempts[batch_id] += 1
+            if attempts[batch_id] < MAX_ATTEMPTS or not await give_up(batch_id, repr(err)):
+                delay = RETRY_DELAY * 2 ** (attempts[batch_id] - 1)
+                asyncio.get_running_loop().call_later(delay, queue.put_nowait, batch_id)
+                continue
+        pending -= 1
+        queued.discard(batch_id)
+        attempts.pop(batch_id, None)
+
+
+async def give_up(batch_id, error):
+    """Dead-letter a batch, returns False if that failed too and the batch must be retried."""
+    try:
+        await dead_letter(batch_id, error)
+    except asyncio.CancelledError:
+        raise
+    except Exception as err:
+        logger.exception('Tracking batch %s could not be parked: %r', batch_id, err)
+        return False
+    return True
+
+
+def metrics():
+    return {
+        'pending': pending, 'max_pending': MAX_PENDING, 'consumers': len(consumer_tasks), 'retrying': len(attempts),
+    }
@@ -0,0 +1,87 @@
+import asyncio
+import contextlib
+import logging
+
+from peewee import Case, fn
+
+import entities as e
+
+logger = logging.getLogger(__name__)
+
+
+class WalletSlot:
+    """In-memory state of one hot wallet."""
+
+    def __init__(self, wallet, balance):
+        self.wallet = wallet
+        self.balance = balance
+        self.busy = 0
+        self.sent = 0
+        self.seqno = None
+        self.lock = asyncio.Lock()
+
+    def as_dict(self):
+        return {'address': self.wallet.address, 'balance': self.balance, 'busy': self.busy, 'sent': self.sent,
+                'seqno': self.seqno}
+
+
+class WalletAllocator:
+    """Spreads outgoing transfers over all wallets, one transfer at a time per wallet.
+
+    Balances are tracked from the ledger: tips received by a wallet minus withdrawals sent from it.
+    """
+
+    def __init__(self):
+        self.slots = {}
+
+    async def load(self):
+        wallets = await e.objects.execute(e.Wallet.select())
+        balances = await self.ledger_balances()
+        self.slots = {wallet.id: WalletSlot(wallet, balances.get(wallet.id) or 0) for wallet in wallets}
+        logger.info('Loaded %d wallets', len(self.slots))
+
+    async def refresh(self):
+        """Reset the balances to the ledger, which has the tips stored by other processes too."""
+        balances = await self.ledger_balances()
+        for wallet_id, slot in self.slots.items():
+            slot.balance = balances.get(wallet_id) or 0
+
+    @staticmethod
+    async def ledger_balances():
+        return dict(await e.objects.execute(
+            e.Transaction.select(
+                e.Transaction.wallet,
+                fn.SUM(Case(None, [(e.Transaction.invoice.is_null(), 0 - e.Transaction.amount)], e.Transaction.amount)),
+            ).group_by(e.Transaction.wallet).tuples()
+        ))
+
+    def pick(self, amount):
+        """The least busy wallet that can cover the amount, or just the least busy one if none can."""
+        if not self.slots:
+            raise RuntimeError('No wallets')
+        slots = sorted(self.slots.values(), key=lambda slot: (slot.balance < amount, slot.busy, -slot.balance))
+        return slots[0]
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, amount):
+        """Hold a wallet for one transfer and deduct the amount from its balance."""
+        slot = self.pick(amount)
+        slot.busy += 1
+        try:
+            async with slot.lock:
+                slot.balance -= amount
+                yield slot
+        finally:
+            slot.busy -= 1
+
+    def confirmed(self, slot, seqno):
+        slot.sent += 1
+        slot.seqno = seqno
+
+    def credit(self, wallet_id, amount):
+        slot = self.slots.get(wallet_id)
+        if slot is not None:
+            slot.balance += amount
+
+    def metrics(self):
+        return [slot.as_dict() for slot in self.slots.values()]
@@ -14,6 +14,9 @@ export type Payment = {
 	source: Address,
 	amount: number,
 	message: string,
+	// Identity of the incoming transaction, lets the receiver drop redelivered payments
+	lt: string,
+	hash: string,
 };
 
 export type PaymentsUpdate = {
@@ -93,6 +96,8 @@ export class PaymentProcessor {
 				source: tr.inMessage.source,
 				amount: tr.inMessage.value.toNumber(),
 				message: body.text,
+				lt: tr.id.lt,
+				hash: tr.id.hash,
 			});
 		}
 
@@ -5,7 +5,8 @@ import Koa from 'koa';
 import koaBody from 'koa-body';
 import Router from 'koa-router';
 
-import { Address, AllWalletContractTypes, TonClient, Wallet, WalletContract, WalletV3R2Source } from "ton";
+import { Address, AllWalletContractTypes, Cell, CellMessage, CommentMessage, CommonMessageInfo, ExternalMessage, InternalMessage, TonClient, Wallet, WalletContract, WalletV3R2Source } from "ton";
+import { sign } from "ton-crypto";
 
 import { tonClient } from "./TONParameters.js";
 import { PaymentProcessor } from "../ton_payments/PaymentProcessor.js";
@@ -14,6 +15,9 @@ import { allTypes } from 'ton/dist/client/Wallet';
 
 
 const maxSendRetries = 3;
+// Wallet v3 accepts at most 4 internal messages in one transfer
+const maxBatchMessages = 4;
+const defaultWalletId = 698983191;
 
 const retrier = retrierFactory(maxSendRetries, 25);
 
@@ -63,52 +67,35 @@ router.all('/startPaymentTracking', koaBodyParser, async ctx => {
 
 	paymentProcessor.startPaymentTracking(
 		address, trackingState,
-		paymentsUpdate => fetch(callbackUrl, {
-			method: 'POST',
-			headers: {
-				'Content-Type': 'application/json',
-			},
-			body: JSON.stringify({
-				...paymentsUpdate,
-				payments: paymentsUpdate.payments.map(p => ({
-					...p,
-					source: p.source.toFriendly(),
-				})),
-				address: addressString,
-			}),
-		}),
+		async paymentsUpdate => {
+			const resp = await fetch(callbackUrl, {
+				method: 'POST',
+				headers: {
+					'Content-Type': 'application/json',
+				},
+				body: JSON.stringify({
+					...paymentsUpdate,
+					payments: paymentsUpdate.payments.map(p => ({
+						...p,
+						source: p.source.toFriendly(),
+					})),
+					address: addressString,
+				}),
+			});
+			// Not accepted (e.g. 429/503 when the receiver is busy): keep the tracking state and deliver again
+			if (!resp.ok)
+				throw new Error(`Callback failed: ${resp.status} ${resp.statusText}`);
+		},
 	);
 
 	ctx.body = 'OK';
 });
 
-async function confirmedSend(wallet: Wallet, params: {
-	sourceKey: Buffer,
-	destinationAddress: Address,
-	amount: number | string,
-	message?: string,
-	senderPaysFees: boolean,
-}) {
-	const {
-		sourceKey,
-		destinationAddress,
-		amount,
-		message,
-		senderPaysFees,
-	} = params;
-
+async function confirmedTransfer(wallet: Wallet, transfer: (seqno: number) => Promise<any>) {
 	const startingSeqno = await wallet.getSeqNo();
 
 	for (let i = 0; i < maxSendRetries; i++) {
-		await wallet.transfer({
-			bounce: false,
-			secretKey: sourceKey,
-			seqno: startingSeqno,
-			to: destinationAddress,
-			value: new BN(amount),
-			payload: message,
-			sendMode: 2 + (senderPaysFees ? 1 : 0),
-		});
+		await transfer(startingSeqno);
 
 		for (let j = 0; j < 3; j++) {
 			await sleep(20);
@@ -139,6 +126,73 @@ async function confirmedSend(wallet: Wallet, params: {
 	return false;
 }
 
+async function confirmedSend(wallet: Wallet, params: {
+	sourceKey: Buffer,
+	destinationAddress: Address,
+	amount: number | string,
+	message?: string,
+	senderPaysFees: boolean,
+}) {
+	const {
+		sourceKey,
+		destinationAddress,
+		amount,
+		message,
+		senderPaysFees,
+	} = params;
+
+	return await confirmedTransfer(wallet, seqno => wallet.transfer({
+		bounce: false,
+		secretKey: sourceKey,
+		seqno,
+		to: destinationAddress,
+		value: new BN(amount),
+		payload: message,
+		sendMode: 2 + (senderPaysFees ? 1 : 0),
+	}));
+}
+
+type BatchMessage = {
+	destinationAddress: Address,
+	amount: number | string,
+	message?: string,
+};
+
+// Same as Wallet.transfer, but with several internal messages signed under one seqno
+async function batchTransfer(wallet: Wallet, sourceKey: Buffer, seqno: number, messages: BatchMessage[], senderPaysFees: boolean) {
+	const signingMessage = new Cell();
+	signingMessage.bits.writeUint(defaultWalletId, 32);
+	signingMessage.bits.writeUint(Math.floor(Date.now() / 1000) + 60, 32);
+	signingMessage.bits.writeUint(seqno, 32);
+	for (const { destinationAddress, amount, message } of messages) {
+		signingMessage.bits.writeUint8(2 + (senderPaysFees ? 1 : 0));
+		const order = new Cell();
+		new InternalMessage({
+			to: destinationAddress,
+			value: new BN(amount),
+			bounce: false,
+			body: new CommonMessageInfo({
+				body: message ? new CommentMessage(message) : undefined,
+			}),
+		}).writeTo(order);
+		signingMessage.refs.push(order);
+	}
+
+	const body = new Cell();
+	body.bits.writeBuffer(sign(signingMessage.hash(), sourceKey));
+	body.writeCell(signingMessage);
+
+	const external = new Cell();
+	new ExternalMessage({
+		to: wallet.address,
+		body: new CommonMessageInfo({
+			body: new CellMessage(body),
+		}),
+	}).writeTo(external);
+
+	await tonClient.sendFile(external.toBoc({ idx: false }));
+}
+
 router.all('/send', koaBodyParser, async ctx => {
 	console.log(typeof ctx.request.body, ctx.request.body);
 	let {
@@ -205,6 +259,65 @@ router.all('/send', koaBodyParser, async ctx => {
 	}
 });
 
+router.all('/sendBatch', koaBodyParser, async ctx => {
+	console.log(typeof ctx.request.body, ctx.request.body);
+	let {
+		sourceKey: sourceKeyString,
+		sourceAddress: sourceAddressString,
+		messages: messageParams,
+		senderPaysFees,
+	} = ctx.request.body;
+
+	if (!sourceKeyString)
+		throw new Error(`Missing sourceKey`);
+	const sourceKey = Buffer.from(sourceKeyString, 'hex');
+
+	if (!sourceAddressString)
+		throw new Error('Missing sourceAddressString');
+
+	if (!Array.isArray(messageParams) || messageParams.length == 0)
+		throw new Error('Missing messages');
+	if (messageParams.length > maxBatchMessages)
+		throw new Error(`At most ${maxBatchMessages} messages are allowed, not: ${messageParams.length}`);
+
+	const messages: BatchMessage[] = messageParams.map((m: any) => {
+		if (!m.destinationAddress)
+			throw new Error('Missing destinationAddress');
+		if (m.amount == undefined)
+			throw new Error('Missing amount');
+		return {
+			destinationAddress: Address.parse(m.destinationAddress),
+			amount: m.amount,
+			message: m.message,
+		};
+	});
+
+	if (typeof senderPaysFees === 'string')
+		senderPaysFees = senderPaysFees.toLowerCase() === 'true' || senderPaysFees === '1';
+	senderPaysFees = !!senderPaysFees;
+
+	const wallet = Wallet.openByType(tonClient, 0, sourceKey, 'org.ton.wallets.v3.r2');
+
+	const sendResult = await confirmedTransfer(wallet,
+		seqno => batchTransfer(wallet, sourceKey, seqno, messages, senderPaysFees));
+
+	if (sendResult) {
+		ctx.body = {
+			...sendResult,
+			results: messageParams.map((m: any, index: number) => ({
+				index,
+				destinationAddress: m.destinationAddress,
+				amount: m.amount,
+			})),
+		};
+		console.log('Batch transaction successfull');
+	} else {
+		ctx.response.status = 400;
+		ctx.response.body = `Transfer unsuccessfull`;
+		console.error('Batch transaction failed');
+	}
+});
+
 app.use(router.routes())
    .use(router.allowedMethods());
 